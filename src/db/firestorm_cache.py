@@ -0,0 +1,178 @@
+"""
+    A local on-disk cache for firestorms: the (preprocessed) DataFrame that was loaded for a query set is stored as
+    a parquet file that is keyed by the query, the projection and the filters that were applied to it.
+    A cached file is only used as long as the watermark of the query set (number of matching tweets and the latest
+    fetch_date in the collection) did not change.
+"""
+
+import hashlib
+import json
+import os
+from typing import Callable, Dict, Sequence, Tuple, Union
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from bson import json_util
+from mongoengine import QuerySet
+
+from src.utils.output_folders import DATA_CACHE_FOLDER
+
+FIRESTORM_CACHE_FOLDER = DATA_CACHE_FOLDER + "firestorms/"
+_METADATA_KEY = b"firestorm_cache"
+
+
+def _filter_key(filter: Callable) -> Union[tuple, str]:
+    """Returns a description of a filter (see src/twitter_data/filters.py) that can be used as part of a cache key"""
+    if hasattr(filter, "spec"):
+        return filter.spec
+    # fall back to the name of the filter and the values it was created with
+    closure_values = [cell.cell_contents for cell in filter.__closure__ or []]
+    return f"{filter.__qualname__}{closure_values}"
+
+
+def cache_key(query_set: QuerySet, filters: Sequence[Callable] = []) -> str:
+    """Returns the key under which the frame for the query set (and filters) is cached
+
+    :param query_set: query set that is loaded
+    :param filters: filters that are applied to the loaded frame, defaults to []
+    :return: key for the cache
+    """
+    key_parts = {
+        "collection": query_set._document._get_collection_name(),
+        "query": query_set._query,
+        "projection": query_set._cursor_args.get("projection"),
+        "filters": [_filter_key(filter) for filter in filters],
+    }
+    return hashlib.sha1(
+        json_util.dumps(key_parts, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+def watermark(query_set: QuerySet) -> Dict:
+    """Returns the current watermark of the query set - if it changes, cached frames for it are outdated
+
+    :param query_set: query set for which the watermark should be calculated
+    :return: dict containing the number of documents in the query set and the latest fetch_date in the collection
+    """
+    latest_fetch = query_set._document._get_collection().find_one(
+        {}, {"fetch_date": 1}, sort=[("fetch_date", -1)]
+    )
+    return {
+        "count": query_set.count(),
+        "max_fetch_date": json_util.dumps(
+            latest_fetch and latest_fetch.get("fetch_date")
+        ),
+    }
+
+
+def _cache_file(key: str) -> str:
+    return f"{FIRESTORM_CACHE_FOLDER}{key}.parquet"
+
+
+def read_cached_frame(
+    key: str, current_watermark: Dict
+) -> Union[Tuple[pd.DataFrame, Dict], None]:
+    """Reads a frame from the cache
+
+    :param key: cache key of the frame (see cache_key)
+    :param current_watermark: current watermark of the query set (see watermark)
+    :return: None if no up to date frame is cached, otherwise a tuple of (1) the cached frame and (2) the metadata
+    that was stored with it
+    """
+    if not os.path.exists(_cache_file(key)):
+        return None
+
+    table = pq.read_table(_cache_file(key))
+    cache_metadata = json.loads(table.schema.metadata[_METADATA_KEY])
+    if cache_metadata["watermark"] != current_watermark:
+        print(f"Cached firestorm {key} is outdated.")
+        return None
+
+    tweets_df = table.to_pandas()
+    for column in cache_metadata["json_columns"]:
+        tweets_df[column] = tweets_df[column].apply(
+            lambda x: json_util.loads(x) if isinstance(x, str) else None
+        )
+    return tweets_df, cache_metadata["metadata"]
+
+
+def write_cached_frame(
+    key: str, current_watermark: Dict, tweets_df: pd.DataFrame, metadata: Dict = {}
+) -> None:
+    """Writes a frame to the cache
+
+    :param key: cache key of the frame (see cache_key)
+    :param current_watermark: watermark of the query set the frame was loaded from (see watermark)
+    :param tweets_df: frame to cache
+    :param metadata: additional (json serializable) data that is stored with the frame, defaults to {}
+    """
+    # nested values (e.g. entities or referenced_tweets) have varying structures and are stored as json
+    tweets_df = tweets_df.copy()
+    json_columns = [
+        column
+        for column in tweets_df.columns
+        if tweets_df[column].dtype == object
+        and tweets_df[column].map(lambda x: isinstance(x, (dict, list))).any()
+    ]
+    for column in json_columns:
+        tweets_df[column] = tweets_df[column].apply(
+            lambda x: json_util.dumps(x) if isinstance(x, (dict, list)) else None
+        )
+
+    try:
+        table = pa.Table.from_pandas(tweets_df)
+    except (pa.ArrowInvalid, pa.ArrowTypeError) as e:
+        print(f"WARNING: Firestorm {key} could not be cached: {e}")
+        return
+
+    cache_metadata = {
+        "watermark": current_watermark,
+        "json_columns": json_columns,
+        "metadata": metadata,
+    }
+    table = table.replace_schema_metadata(
+        {**table.schema.metadata, _METADATA_KEY: json.dumps(cache_metadata)}
+    )
+
+    os.makedirs(FIRESTORM_CACHE_FOLDER, exist_ok=True)
+    # write to a temporary file first so that interrupted writes never leave a broken cache file behind
+    pq.write_table(table, _cache_file(key) + ".tmp")
+    os.replace(_cache_file(key) + ".tmp", _cache_file(key))
+
+
+def cached_frame(
+    query_set: QuerySet,
+    load_frame: Callable[[], Tuple[pd.DataFrame, Dict]],
+    filters: Sequence[Callable] = [],
+) -> Tuple[pd.DataFrame, Dict]:
+    """Returns the frame for the query set from the cache - if it is not cached (or outdated), it is loaded with
+    load_frame and written to the cache
+
+    :param query_set: query set that is loaded
+    :param load_frame: function loading the frame, returns a tuple of (1) the frame and (2) metadata to store with it
+    :param filters: filters that load_frame applies to the frame, defaults to []
+    :return: Tuple of (1) the frame and (2) the metadata stored with it
+    """
+    key = cache_key(query_set, filters)
+    current_watermark = watermark(query_set)
+
+    cached = read_cached_frame(key, current_watermark)
+    if cached:
+        return cached
+
+    tweets_df, metadata = load_frame()
+    write_cached_frame(key, current_watermark, tweets_df, metadata)
+    return tweets_df, metadata
+
+
+def clear_firestorm_cache() -> None:
+    """Deletes all cached firestorms (e.g. after attributes were added to the tweets, which does not change the
+    watermark)"""
+    if not os.path.exists(FIRESTORM_CACHE_FOLDER):
+        return
+    for filename in os.listdir(FIRESTORM_CACHE_FOLDER):
+        try:
+            os.remove(FIRESTORM_CACHE_FOLDER + filename)
+        except FileNotFoundError:  # removed by another process in the meantime
+            pass
@@ -1,20 +1,173 @@
-import json
+import csv
+import os
+from typing import Dict, List, Sequence, Tuple, Union
 
+import bson
 import pandas as pd
-from mongoengine import QuerySet
-import os
+import pyarrow as pa
+from mongoengine import (
+    BooleanField,
+    DateTimeField,
+    FloatField,
+    IntField,
+    LongField,
+    QuerySet,
+    ReferenceField,
+    StringField,
+)
 
 from src.db.connection import connect_to_mongo
 from src.db.schemes import Tweets
 
+# string attributes with only a handful of distinct values - these are loaded as categoricals
+CATEGORICAL_FIELDS = ("lang", "tweet_type", "user_type", "reply_settings", "source")
+
+# tweets that may end up in a sample for labeling: integrating retweets could mean that labelers are shown the
+# same tweet multiple times, some older fetches (not used in thesis) have no tweet_type and we only use german tweets
+SAMPLE_MATCH = {
+    "tweet_type": {"$nin": ["retweet without comment", None]},
+    "lang": "de",
+}
+
+
+def _arrow_type(field, db_field: str) -> Union[pa.DataType, None]:
+    """Returns the arrow type a mongoengine field is loaded as (None if it is kept as python objects)"""
+    if isinstance(field, DateTimeField):
+        return pa.timestamp("ms", tz="UTC")
+    elif isinstance(field, BooleanField):
+        return pa.bool_()
+    elif isinstance(field, (IntField, LongField)):
+        return pa.int64()
+    elif isinstance(field, FloatField):
+        return pa.float64()
+    elif isinstance(field, StringField):
+        if db_field in CATEGORICAL_FIELDS:
+            return pa.dictionary(pa.int32(), pa.string())
+        return pa.string()
+    elif isinstance(field, ReferenceField):
+        # references are stored as the primary key of the referenced document
+        referenced_doc = field.document_type
+        return _arrow_type(referenced_doc._fields[referenced_doc._meta["id_field"]], "")
+    return None
+
+
+def _to_arrow_array(values: list, arrow_type: pa.DataType) -> pa.Array:
+    if pa.types.is_dictionary(arrow_type):
+        return pa.array(values, pa.string()).dictionary_encode()
+    return pa.array(values, arrow_type)
+
+
+def _load_columns(input_data: QuerySet, batch_size: int) -> Dict[str, dict]:
+    """Reads the QuerySet as raw BSON batches and builds the columns batch by batch so that only one batch of
+    decoded documents is held in memory at a time
+
+    :param input_data: The query set that should be loaded (filter, projection, ordering, skip and limit are used)
+    :param batch_size: number of documents per batch
+    :return: a dict mapping column name to a dict containing its arrow type ("type", None for python objects)
+    and the list of its chunks ("chunks", arrow arrays for typed columns or lists for python objects)
+    """
+    doc_cls = input_data._document
+    field_types = {
+        field.db_field: _arrow_type(field, field.db_field)
+        for field in doc_cls._fields.values()
+    }
+
+    cursor = doc_cls._get_collection().find_raw_batches(
+        input_data._query,
+        projection=input_data._cursor_args.get("projection"),
+        batch_size=batch_size,
+    )
+    if input_data._ordering:
+        cursor.sort(input_data._ordering)
+    if input_data._skip is not None:
+        cursor.skip(input_data._skip)
+    if input_data._limit is not None:
+        cursor.limit(input_data._limit)
+
+    columns = {}
+    n_rows = 0
+    for raw_batch in cursor:
+        documents = bson.decode_all(raw_batch)
+
+        for document in documents:
+            for key in document:
+                if key not in columns:
+                    # column appears for the first time - fill all previous rows with nulls
+                    columns[key] = {"type": field_types.get(key), "chunks": []}
+                    if n_rows:
+                        columns[key]["chunks"].append([None] * n_rows)
+
+        for key, column in columns.items():
+            column["chunks"].append([document.get(key) for document in documents])
+
+        for key, column in columns.items():
+            if column["type"] is None:
+                continue
+            try:
+                column["chunks"] = [
+                    _to_arrow_array(chunk, column["type"])
+                    if isinstance(chunk, list)
+                    else chunk
+                    for chunk in column["chunks"]
+                ]
+            except (pa.ArrowInvalid, pa.ArrowTypeError):
+                # values in the db do not match the schema - keep the column as python objects
+                print(f"WARNING: Column {key} is loaded as python objects.")
+                column["type"] = None
+                column["chunks"] = [
+                    chunk.to_pylist() if isinstance(chunk, pa.Array) else chunk
+                    for chunk in column["chunks"]
+                ]
+
+        n_rows += len(documents)
+
+    return columns
+
 
-def query_set_to_df(input_data: QuerySet) -> pd.DataFrame:
+def query_set_to_arrow(input_data: QuerySet, batch_size: int = 10000) -> pa.Table:
+    """Transforms a mongoengine QuerySet into an arrow Table without going through json (see query_set_to_df)
+
+    :param input_data: The query set that should be transformed to a Table
+    :param batch_size: number of documents that are read and decoded at once, defaults to 10000
+    :return: Data as an arrow Table (dates as timestamp[ms, UTC], categorical strings dictionary encoded)
+    """
+    columns = _load_columns(input_data, batch_size)
+    return pa.table(
+        {
+            key: pa.chunked_array(column["chunks"], column["type"])
+            if column["type"] is not None
+            else pa.array([value for chunk in column["chunks"] for value in chunk])
+            for key, column in columns.items()
+        }
+    )
+
+
+def query_set_to_df(input_data: QuerySet, batch_size: int = 10000) -> pd.DataFrame:
     """Transforms a mongoengine QuerySet into a DataFrame
 
+    The documents are read as raw BSON batches and converted into typed columns directly: dates are unix
+    timestamps in ms (int64), the strings in CATEGORICAL_FIELDS are categoricals, booleans are bools (object if
+    some values are missing) and nested fields (e.g. entities) are kept as python objects.
+
     :param input_data: The query set that should be transformed to a DataFrame
+    :param batch_size: number of documents that are read and decoded at once, defaults to 10000
     :return: Data as a DataFrame
     """
-    return pd.DataFrame.from_records(json.loads(input_data.to_json()))
+    columns = _load_columns(input_data, batch_size)
+
+    data = {}
+    for key, column in columns.items():
+        if column["type"] is None:
+            data[key] = pd.Series(
+                [value for chunk in column["chunks"] for value in chunk], dtype=object
+            )
+            continue
+        chunked_array = pa.chunked_array(column["chunks"], column["type"])
+        if pa.types.is_timestamp(column["type"]):
+            chunked_array = chunked_array.cast(pa.int64())
+        data[key] = chunked_array.to_pandas()
+
+    return pd.DataFrame(data)
 
 
 def get_random_oids(collection, sample_size: int) -> list:
@@ -40,41 +193,128 @@ def get_random_documents(DocCls, sample_size: int) -> QuerySet:
     return DocCls.objects(id__in=random_oids)
 
 
-def tweet_sample_to_csv(sample_size: int, output_filename: str):
-    """A specific implementation of gathering/filtering steps for collecting a set of sample tweets
+def stratum_sample_sizes(
+    collection, sample_size: int, strata: Sequence[str] = [], match: Dict = {}
+) -> List[Tuple[Dict, int]]:
+    """Splits the sample size between the strata proportionally to the number of matching documents in each stratum
 
-    :param sample_size: Number of tweets that should be in the sample
-    :param output_filename: Filename to which the sample should be written
+    :param collection: collection the sample is drawn from
+    :param sample_size: size of the whole sample
+    :param strata: fields whose value combinations form the strata (e.g. ["firestorm", "tweet_type"]), no
+    stratification if empty, defaults to []
+    :param match: condition the sampled documents must fulfill, defaults to {}
+    :return: list of tuples of (1) the condition selecting the stratum and (2) the sample size for the stratum
     """
-    # we get a much larger sample size as we are applying a lot of filtering steps - unsafe implementation
-    sample = get_random_documents(Tweets, sample_size * 10).only(
-        "text", "tweet_type", "lang", "id"
-    )
-    sample_df = query_set_to_df(sample)
-
-    # integrating retweet could mean that labelers are shown the same tweet multiple times
-    sample_df = sample_df[sample_df["tweet_type"] != "retweet without comment"]
-    # some older fetches (not used in thesis) have nan and are kicked out here!
-    sample_df = sample_df[sample_df["tweet_type"].notna()]
-    # only use german tweets
-    sample_df = sample_df[sample_df.lang == "de"]
-    # shuffle random sample
-    sample_df = sample_df.sample(frac=1).reset_index(drop=True)
-
-    if len(sample_df) < sample_size:
+    pipeline = [
+        {"$match": match},
+        {
+            "$group": {
+                # documents lacking a field form one stratum with the documents in which it is null
+                "_id": {
+                    stratum: {"$ifNull": [f"${stratum}", None]} for stratum in strata
+                }
+                or None,
+                "count": {"$sum": 1},
+            }
+        },
+    ]
+    # {field: None} matches documents in which the field is missing or null
+    stratum_counts = [
+        (
+            {field: (stratum["_id"] or {}).get(field) for field in strata},
+            stratum["count"],
+        )
+        for stratum in collection.aggregate(pipeline)
+    ]
+    total_count = sum(count for _, count in stratum_counts)
+    if total_count < sample_size:
         raise Exception(
-            "Method did not produce a big enough sample. Check the filtering steps in the method or your query."
+            f"Only {total_count} documents match the sample condition, {sample_size} were requested. "
+            f"Check the filtering steps in the method or your query."
         )
 
-    selected_sample = sample_df.head(sample_size)
+    # largest remainder method, so that the sizes of the strata add up to the sample size
+    exact_sizes = [count * sample_size / total_count for _, count in stratum_counts]
+    sizes = [int(size) for size in exact_sizes]
+    by_remainder = sorted(
+        range(len(sizes)), key=lambda i: exact_sizes[i] - sizes[i], reverse=True
+    )
+    for i in by_remainder[: sample_size - sum(sizes)]:
+        sizes[i] += 1
 
-    selected_sample = selected_sample[["_id", "text"]]
+    return [
+        (stratum, size) for (stratum, _), size in zip(stratum_counts, sizes) if size > 0
+    ]
 
-    selected_sample.to_csv(
-        output_filename,
-        sep="\t",
-        header=["id", "text"],
-    )
+
+def sample_pipeline(
+    collection,
+    sample_size: int,
+    strata: Sequence[str] = [],
+    match: Dict = {},
+    fields: Sequence[str] = ["text"],
+) -> List[Dict]:
+    """Builds a single aggregation that draws a random (stratified) sample of the documents matching the condition.
+    The condition is applied before $sample, so only the sampled documents are transferred.
+
+    :param collection: collection the sample is drawn from
+    :param sample_size: size of the sample
+    :param strata: fields whose value combinations form the strata (see stratum_sample_sizes), defaults to []
+    :param match: condition the sampled documents must fulfill, defaults to {}
+    :param fields: fields of the sampled documents that are returned (in addition to the _id), defaults to ["text"]
+    :return: aggregation pipeline
+    """
+    projection = {"$project": {field: 1 for field in fields}}
+    stratum_pipelines = [
+        [
+            # the values of the stratum were grouped from matching documents, so they never contradict the match
+            {"$match": {**match, **stratum}},
+            {"$sample": {"size": size}},
+            projection,
+        ]
+        for stratum, size in stratum_sample_sizes(
+            collection, sample_size, strata, match
+        )
+    ]
+
+    if not stratum_pipelines:
+        raise ValueError(
+            f"No documents can be sampled for a sample size of {sample_size}."
+        )
+
+    pipeline = stratum_pipelines[0]
+    for stratum_pipeline in stratum_pipelines[1:]:
+        pipeline.append(
+            {"$unionWith": {"coll": collection.name, "pipeline": stratum_pipeline}}
+        )
+    if len(stratum_pipelines) > 1:
+        # shuffle the strata into each other
+        pipeline.append({"$sample": {"size": sample_size}})
+    return pipeline
+
+
+def tweet_sample_to_csv(
+    sample_size: int,
+    output_filename: str,
+    strata: Sequence[str] = [],
+    match: Dict = SAMPLE_MATCH,
+):
+    """A specific implementation of gathering/filtering steps for collecting a set of sample tweets
+
+    :param sample_size: Number of tweets that should be in the sample
+    :param output_filename: Filename to which the sample should be written
+    :param strata: fields by which the sample is stratified (e.g. ["firestorm", "tweet_type"]), defaults to []
+    :param match: condition the sampled tweets must fulfill, defaults to SAMPLE_MATCH
+    """
+    collection = Tweets._get_collection()
+    pipeline = sample_pipeline(collection, sample_size, strata, match)
+
+    # the sample is streamed from the cursor to the file (same layout as DataFrame.to_csv with the index)
+    with open(output_filename, "w", newline="") as f:
+        writer = csv.writer(f, delimiter="\t", lineterminator="\n")
+        writer.writerow(["", "id", "text"])
+        for i, tweet in enumerate(collection.aggregate(pipeline, allowDiskUse=True)):
+            writer.writerow([i, tweet["_id"], tweet["text"]])
 
 
 if __name__ == "__main__":
@@ -0,0 +1,132 @@
+"""
+    Creates (or verifies) the indexes that are declared in the meta of the db schemes and prints statistics on them
+    as well as explain() summaries for the standard queries that are used for loading firestorms.
+"""
+
+from typing import Dict, List
+
+from mongoengine import Document, QuerySet
+
+from src.db.connection import connect_to_mongo
+from src.db.queried import QUERIES, query_iterator
+from src.db.schemes import Tweets, Users
+
+
+def ensure_indexes(doc_classes: List[Document] = [Tweets, Users]) -> None:
+    """Creates all indexes declared in the meta of the documents (existing indexes are left untouched)
+
+    :param doc_classes: documents for which the indexes should be created, defaults to [Tweets, Users]
+    """
+    for doc_cls in doc_classes:
+        print(f"Ensuring indexes for {doc_cls.__name__}...")
+        doc_cls.ensure_indexes()
+        index_comparison = doc_cls.compare_indexes()
+        if index_comparison["missing"]:
+            print(f"WARNING: Indexes {index_comparison['missing']} are still missing!")
+        if index_comparison["extra"]:
+            print(
+                f"Indexes {index_comparison['extra']} exist in the db but are not declared in the scheme."
+            )
+
+
+def print_index_stats(doc_cls: Document) -> None:
+    """Prints size and usage of each index of the documents collection
+
+    :param doc_cls: document for whose collection the index stats should be printed
+    """
+    collection = doc_cls._get_collection()
+    index_sizes = collection.database.command("collStats", collection.name)[
+        "indexSizes"
+    ]
+
+    print(f"=====INDEXES OF {collection.name}")
+    for index_stats in collection.aggregate([{"$indexStats": {}}]):
+        name = index_stats["name"]
+        print(
+            f"{name}: key {dict(index_stats['key'])}, {index_sizes.get(name, 0) / 1024 ** 2:.1f} MB, "
+            f"used {index_stats['accesses']['ops']} times since {index_stats['accesses']['since']}"
+        )
+
+
+def _plan_stages(plan: dict) -> List[dict]:
+    """Flattens a (winning) query plan into the list of its stages (from the top most stage to the input stages)"""
+    stages = [plan]
+    for input_plan in plan.get("inputStages", []) + [plan.get("inputStage")]:
+        if input_plan:
+            stages.extend(_plan_stages(input_plan))
+    return stages
+
+
+def explain_summary(query_set: QuerySet) -> Dict:
+    """Summarizes the explain() output of a query
+
+    :param query_set: query to explain
+    :return: dict containing the stages of the winning plan, the indexes used by it and its execution stats
+    """
+    explanation = query_set.explain()
+    winning_plan = explanation["queryPlanner"]["winningPlan"]
+    # newer mongo versions with the slot based execution engine nest the plan one level deeper
+    stages = _plan_stages(winning_plan.get("queryPlan", winning_plan))
+    execution_stats = explanation.get("executionStats", {})
+
+    return {
+        "stages": " <- ".join(stage["stage"] for stage in stages),
+        "indexes": [stage["indexName"] for stage in stages if "indexName" in stage],
+        "n_returned": execution_stats.get("nReturned"),
+        "keys_examined": execution_stats.get("totalKeysExamined"),
+        "docs_examined": execution_stats.get("totalDocsExamined"),
+        "time_ms": execution_stats.get("executionTimeMillis"),
+    }
+
+
+def standard_queries(firestorm: str, query_dict: dict) -> Dict[str, QuerySet]:
+    """Returns the queries that are typically used for loading a firestorm
+
+    :param firestorm: name of the firestorm (key in QUERIES)
+    :param query_dict: query dict of the firestorm (see QUERIES)
+    :return: dict mapping a description of the query to the query
+    """
+    queries = {
+        "firestorm": Tweets.objects(firestorm=firestorm),
+        "firestorm (de)": Tweets.objects(firestorm=firestorm, lang="de"),
+    }
+    if query_dict["true_start_date"] and query_dict["true_end_date"]:
+        queries["firestorm (de, true time range)"] = Tweets.objects(
+            firestorm=firestorm,
+            lang="de",
+            created_at__gte=query_dict["true_start_date"],
+            created_at__lt=query_dict["true_end_date"],
+        )
+
+    first_tweet = queries["firestorm"].only("author_id").as_pymongo().first()
+    if first_tweet and "author_id" in first_tweet:
+        queries["author timeline"] = Tweets.objects(
+            author_id=first_tweet["author_id"]
+        ).order_by("created_at")
+
+    return queries
+
+
+def explain_standard_queries(query_dicts: dict = QUERIES) -> None:
+    """Prints explain() summaries for the standard queries of each firestorm (COLLSCAN stages mean that no index
+    could be used)
+
+    :param query_dicts: query dicts for the firestorms whose queries should be explained, defaults to QUERIES
+    """
+    for key, query_dict in query_iterator(query_dicts):
+        for description, query_set in standard_queries(key, query_dict).items():
+            summary = explain_summary(query_set)
+            print(
+                f"{key} - {description}: {summary['stages']} (indexes: {summary['indexes']}), "
+                f"{summary['n_returned']} returned, {summary['keys_examined']} keys and "
+                f"{summary['docs_examined']} docs examined in {summary['time_ms']}ms"
+            )
+
+
+if __name__ == "__main__":
+    connect_to_mongo()
+
+    ensure_indexes()
+    print_index_stats(Tweets)
+    print_index_stats(Users)
+    explain_standard_queries()
@@ -1,8 +1,17 @@
 import json
-from typing import Dict, List, Tuple
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from typing import Dict, Iterator, List, Tuple
+
+from pymongo import ReplaceOne
+from pymongo.errors import BulkWriteError
 
 import src.db.schemes as mongo_db
 from src.db.connection import connect_to_mongo
+from src.db.queried import firestorm_for_query
 from src.db.tweet_queries import get_tweets_for_search_query
 from src.discourse_style_metrics.add_attributes_to_entries import (
     add_attributes_to_tweets,
@@ -19,26 +28,157 @@ def file_reader_generator(filename: str, encoding=None):
         yield row
 
 
-def insert_json_lines_file(filename: str, search_params: dict):
-    """Expects a json document where each line represents a json doc not a "true" json file"""
-    for row in file_reader_generator(filename, encoding="utf-8-sig"):
+def file_chunk_generator(
+    filename: str, chunk_size: int = 10000, encoding=None
+) -> Iterator[List[str]]:
+    """Reads the file in chunks of chunk_size lines instead of line by line
+
+    :param filename: file to read from
+    :param chunk_size: number of lines per chunk, defaults to 10000
+    :param encoding: encoding of the file
+    :yield: list of (at most) chunk_size lines
+    """
+    with open(filename, "r", encoding=encoding) as f:
+        while True:
+            chunk = list(islice(f, chunk_size))
+            if not chunk:
+                return
+            yield chunk
+
+
+def tweet_to_document(entry: Dict) -> Dict:
+    """Builds the mongo document for a tweet directly from the parsed json (same conversion and validation as
+    Tweets.from_json(...).save() but without serializing the entry back to json first)
+
+    :param entry: tweet as parsed from the Twitter API json
+    :return: document as it is stored in the Tweets collection
+    """
+    tweet = mongo_db.Tweets._from_son(entry, created=True)
+    tweet.validate()
+    return tweet.to_mongo().to_dict()
+
+
+def tag_firestorm(entry: Dict) -> Dict:
+    """Sets the firestorm tag of a tweet based on the query in its search params (see QUERIES)
+
+    :param entry: tweet as parsed from the Twitter API json (including the search params)
+    :return: the same tweet with the firestorm tag
+    """
+    if "search_params" in entry:
+        entry["firestorm"] = firestorm_for_query(entry["search_params"].get("query"))
+    return entry
+
+
+def parse_json_lines(rows: List[str], search_params: dict) -> Tuple[List[Dict], int]:
+    """Parses json lines into tweet documents (runs in the worker processes of insert_json_lines_file)
+
+    :param rows: lines of a json lines file, each containing one tweet
+    :param search_params: search params that are attached to each tweet
+    :return: Tuple of (1) the parsed documents and (2) the number of lines that could not be parsed
+    """
+    documents = []
+    failed = 0
+    for row in rows:
         try:
             tweet = json.loads(row)
             tweet["search_params"] = search_params
-            insert_one_tweet(tweet)
+            documents.append(tweet_to_document(tag_firestorm(tweet)))
         except Exception as e:
+            failed += 1
             print(f"Tweet insertion failed: {e}")
+    return documents, failed
+
+
+def bulk_upsert_documents(documents: List[Dict], batch_size: int = 1000) -> int:
+    """Upserts the documents into the Tweets collection with unordered bulk writes (existing tweets are replaced,
+    which is the same behaviour as Document.save())
+
+    :param documents: tweet documents as returned by tweet_to_document
+    :param batch_size: number of documents per bulk write, defaults to 1000
+    :return: number of documents that were written successfully
+    """
+    collection = mongo_db.Tweets._get_collection()
+    written = 0
+    for i in range(0, len(documents), batch_size):
+        operations = [
+            ReplaceOne({"_id": document["_id"]}, document, upsert=True)
+            for document in documents[i : i + batch_size]
+        ]
+        try:
+            result = collection.bulk_write(operations, ordered=False)
+            written += result.upserted_count + result.matched_count
+        except BulkWriteError as e:
+            details = e.details
+            written += details["nUpserted"] + details["nMatched"]
+            print(f"Bulk write failed for {len(details['writeErrors'])} tweets.")
+    return written
+
+
+def insert_json_lines_file(
+    filename: str,
+    search_params: dict,
+    processes: int = None,
+    chunk_size: int = 10000,
+    batch_size: int = 1000,
+) -> int:
+    """Expects a json document where each line represents a json doc not a "true" json file
+
+    The file is read in chunks which are parsed in a process pool; the parsed tweets are written with unordered
+    bulk upserts.
+
+    :param filename: json lines file to insert
+    :param search_params: search params that are attached to each tweet
+    :param processes: number of worker processes for parsing, defaults to the number of cpus
+    :param chunk_size: number of lines that are handed to a worker at once, defaults to 10000
+    :param batch_size: number of tweets per bulk write, defaults to 1000
+    :return: number of tweets that were written to the db
+    """
+    processes = processes or os.cpu_count()
+    start_time = time.perf_counter()
+    written, failed = 0, 0
+
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        # only keep a few chunks in flight so that we never hold the whole file in memory
+        max_pending = processes * 2
+        pending = deque()
+        chunks = file_chunk_generator(filename, chunk_size, encoding="utf-8-sig")
+        while True:
+            for chunk in islice(chunks, max_pending - len(pending)):
+                pending.append(executor.submit(parse_json_lines, chunk, search_params))
+            if not pending:
+                break
+
+            documents, failed_in_chunk = pending.popleft().result()
+            failed += failed_in_chunk
+            written += bulk_upsert_documents(documents, batch_size)
+
+            elapsed = time.perf_counter() - start_time
+            print(
+                f"Inserted {written} tweets by now ({written / elapsed:.0f} tweets/s). Continuing..."
+            )
+
+    elapsed = time.perf_counter() - start_time
+    print(
+        f"Inserted {written} tweets in {elapsed:.1f}s ({written / elapsed:.0f} tweets/s); "
+        f"{failed} lines could not be parsed."
+    )
+    return written
 
 
 def insert_one_tweet(entry: Dict) -> None:
-    mongo_db.Tweets.from_json(json.dumps(entry), True).save()
+    mongo_db.Tweets.from_json(json.dumps(tag_firestorm(entry)), True).save()
 
 
-def insert_many_tweets(entries: List[Dict]):
-    tweet_db_instances = [
-        mongo_db.Tweets.from_json(json.dumps(entry)) for entry in entries
-    ]
-    mongo_db.Tweets.objects.insert(tweet_db_instances, loadBulk=False)
+def insert_many_tweets(entries: List[Dict], batch_size: int = 1000) -> int:
+    """Inserts (upserts) many tweets at once with unordered bulk writes
+
+    :param entries: tweets as parsed from the Twitter API json
+    :param batch_size: number of tweets per bulk write, defaults to 1000
+    :return: number of tweets that were written to the db
+    """
+    return bulk_upsert_documents(
+        [tweet_to_document(tag_firestorm(entry)) for entry in entries], batch_size
+    )
 
 
 def clean_json(input_filname: str, output_filename: str) -> Tuple[int, int, int]:
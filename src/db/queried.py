@@ -4,6 +4,7 @@
 """
 
 from datetime import datetime
+from typing import List, Union
 import pytz
 from src.utils.datetime_helpers import day_wrapping_datetimes
 from dateutil import parser as date_parser
@@ -180,3 +181,28 @@ def query_iterator(
             continue
         print(f"Processing {key}")
         yield key, query_dict
+
+
+def firestorm_for_query(query: str) -> Union[str, None]:
+    """Returns the name of the firestorm (key in QUERIES) whose tweets were fetched with the query
+
+    :param query: the full query that was used for fetching the tweets
+    :return: name of the firestorm, None if the query is not part of QUERIES
+    """
+    for key, query_dict in QUERIES.items():
+        if query_dict["query"] == query:
+            return key
+    return None
+
+
+def firestorms_matching_query(query: str) -> List[str]:
+    """Returns the names of all firestorms whose query contains the (partial) query (case insensitive)
+
+    :param query: the query (or a part of the query) that was used for fetching the tweets
+    :return: names of the matching firestorms (keys in QUERIES)
+    """
+    return [
+        key
+        for key, query_dict in QUERIES.items()
+        if query.lower() in query_dict["query"].lower()
+    ]
@@ -63,6 +63,7 @@ class Tweets(Document):
         "TwitterMedia"
     )  # we store media directly in the tweet
     search_params = DictField()
+    firestorm = StringField()  # key of the firestorm in QUERIES (see src/db/queried.py)
     tweet_type = StringField()
     contains_url = BooleanField()
     user_type = StringField()
@@ -71,10 +72,25 @@ class Tweets(Document):
     firestorm_activity_rel = FloatField(min_value=0, max_value=1)
     fetch_date = DateTimeField(default=datetime.utcnow)
     is_offensive = BooleanField()
+    is_offensive_stage = (
+        StringField()
+    )  # model that predicted is_offensive: "linear" or "transformer"
     includes_users = DictField()
     includes_media = ListField()
     includes_tweets = DictField()
 
+    meta = {
+        "indexes": [
+            ("firestorm", "lang", "created_at"),
+            ("firestorm", "created_at"),
+            ("author_id", "created_at"),
+            "created_at",
+            "fetch_date",
+        ],
+        # building indexes on the full collection takes a while - they are created explicitly with src/db/indexes.py
+        "auto_create_index": False,
+    }
+
 
 class Users(Document):
     id = LongField(primary_key=True, required=True)
@@ -91,3 +107,5 @@ class Users(Document):
     public_metrics = DictField()
     protected = BooleanField()
     withheld = BooleanField()
+
+    meta = {"indexes": ["username"], "auto_create_index": False}
@@ -1,17 +1,53 @@
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+from typing import Tuple
+
 import pandas as pd
-from mongoengine.queryset.visitor import Q
+from src.db import firestorm_cache
 from src.db.helpers import query_set_to_df
 from src.db.queried import QUERIES, query_iterator
 from src.db.schemes import Tweets
 
 
 def load_hypothesis_dataset(
-    attributes: list[str] = ["is_offensive", "tweet_type", "user_type", "created_at"]
+    attributes: list[str] = ["is_offensive", "tweet_type", "user_type", "created_at"],
+    max_workers: int = 4,
 ) -> pd.DataFrame:
     return pd.concat(
-        [df for (_, df) in load_firestorms_individually(attributes).items()]
+        [
+            df
+            for (_, df) in load_firestorms_individually(
+                attributes, max_workers=max_workers
+            ).items()
+        ]
+    )
+
+
+def load_firestorm(
+    fs_name: str, attributes: list[str], use_cache: bool = True
+) -> Tuple[pd.DataFrame, float]:
+    """Loads the german tweets of a single firestorm
+
+    :param fs_name: name of the firestorm (key in QUERIES)
+    :param attributes: attributes of the tweets that should be loaded
+    :param use_cache: if true, the firestorm is read from (or written to) the local firestorm cache
+    :return: Tuple of (1) the tweets of the firestorm and (2) the seconds it took to load them
+    """
+    start_time = perf_counter()
+    firestorm_tweets_query_set = Tweets.objects(firestorm=fs_name, lang="de").only(
+        *attributes
     )
 
+    if use_cache:
+        firestorm_df, _ = firestorm_cache.cached_frame(
+            firestorm_tweets_query_set,
+            lambda: (query_set_to_df(firestorm_tweets_query_set), {}),
+        )
+    else:
+        firestorm_df = query_set_to_df(firestorm_tweets_query_set)
+    firestorm_df["firestorm_name"] = fs_name
+    return firestorm_df, perf_counter() - start_time
+
 
 def load_firestorms_individually(
     attributes: list[str] = [
@@ -19,17 +55,32 @@ def load_firestorms_individually(
         "tweet_type",
         "user_type",
         "created_at",
-    ]
+    ],
+    use_cache: bool = True,
+    max_workers: int = 4,
 ) -> pd.DataFrame:
-    fs_collection = {}
-    for fs_name, query_dict in query_iterator(QUERIES):
-        query = query_dict["query"]
-        firestorm_tweets_query_set = Tweets.objects(
-            Q(search_params__query=query) & Q(lang="de")
-        ).only(*attributes)
+    """Loads the firestorms concurrently - loading is mostly waiting for the db, so the threads share the
+    connection pool of the mongo client
 
-        firestorm_df = query_set_to_df(firestorm_tweets_query_set)
-        firestorm_df["firestorm_name"] = fs_name
-        fs_collection[fs_name] = firestorm_df
+    :param attributes: attributes of the tweets that should be loaded
+    :param use_cache: if true, the firestorms are read from (or written to) the local firestorm cache
+    :param max_workers: maximum number of firestorms that are loaded at the same time, defaults to 4
+    :return: dict mapping the name of each firestorm to its tweets
+    """
+    start_time = perf_counter()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            fs_name: executor.submit(load_firestorm, fs_name, attributes, use_cache)
+            for fs_name, _ in query_iterator(QUERIES)
+        }
 
+        fs_collection = {}
+        for fs_name, future in futures.items():
+            firestorm_df, load_time = future.result()
+            print(f"Loaded {len(firestorm_df)} tweets of {fs_name} in {load_time:.1f}s")
+            fs_collection[fs_name] = firestorm_df
+
+    print(
+        f"Loaded {len(fs_collection)} firestorms in {perf_counter() - start_time:.1f}s"
+    )
     return fs_collection
@@ -1,9 +1,25 @@
-from time import sleep
+from time import perf_counter, sleep
 
 from mongoengine import QuerySet
+from pymongo import UpdateOne
+from src.db.connection import connect_to_mongo
+from src.db.firestorm_cache import clear_firestorm_cache
+from src.db.queried import QUERIES, firestorm_for_query
 from src.db.schemes import Tweets
 from src.db.tweet_queries import get_tweets_for_search_query
 
+# attributes that are calculated by us (and not fetched from twitter) and may therefore be written back to tweets
+UPDATABLE_ATTRIBUTES = (
+    "tweet_type",
+    "contains_url",
+    "user_type",
+    "is_offensive",
+    "is_offensive_stage",
+    "user_activity",
+    "firestorm_activity",
+    "firestorm_activity_rel",
+)
+
 
 def add_attribute_to_tweet(tweet: Tweets, attribute: str, value) -> None:
     """Sets an attribute for a specific tweet to a value
@@ -19,6 +35,8 @@ def add_attribute_to_tweet(tweet: Tweets, attribute: str, value) -> None:
         return tweet.update(set__user_type=value)
     elif attribute == "is_offensive":
         return tweet.update(set__is_offensive=value)
+    elif attribute == "is_offensive_stage":
+        return tweet.update(set__is_offensive_stage=value)
     elif attribute == "user_activity":
         return tweet.update(set__user_activity=value)
     elif attribute == "firestorm_activity":
@@ -31,6 +49,85 @@ def add_attribute_to_tweet(tweet: Tweets, attribute: str, value) -> None:
         )
 
 
+class BulkAttributeWriter:
+    """Buffers attribute updates for tweets and writes them back with bulk writes. All attributes that are added
+    for one tweet are merged into a single $set. Use it as a context manager so that remaining updates are flushed
+    when leaving the block:
+
+        with BulkAttributeWriter() as writer:
+            writer.add(tweet_id, "tweet_type", "reply")
+    """
+
+    def __init__(self, flush_size: int = 1000):
+        """
+        :param flush_size: number of buffered tweets after which the updates are written to the db, defaults to 1000
+        """
+        self._flush_size = flush_size
+        self._pending = {}
+        self._written_tweets = 0
+        self._written_values = 0
+        self._bulk_writes = 0
+        self._write_time = 0.0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+        self.report()
+        if self._written_tweets:
+            # attribute updates do not change the watermark of the firestorm cache - cached frames are outdated now
+            clear_firestorm_cache()
+
+    def add(self, tweet_id: int, attribute: str, value) -> None:
+        """Buffers setting an attribute of a specific tweet to a value
+
+        :param tweet_id: id of the tweet to update
+        :param attribute: attribute to update for this tweet
+        :param value: value that this attribute should be set to
+        """
+        if attribute not in UPDATABLE_ATTRIBUTES:
+            raise ValueError(
+                f"No know operation exists for adding the attribute {attribute}"
+            )
+        field = Tweets._fields[attribute]
+        tweet_id = Tweets._fields["id"].to_mongo(tweet_id)
+        self._pending.setdefault(tweet_id, {})[field.db_field] = (
+            None if value is None else field.to_mongo(value)
+        )
+
+        if len(self._pending) >= self._flush_size:
+            self.flush()
+
+    def flush(self) -> None:
+        """Writes all buffered updates to the db"""
+        if not self._pending:
+            return
+
+        operations = [
+            UpdateOne({"_id": tweet_id}, {"$set": values})
+            for tweet_id, values in self._pending.items()
+        ]
+        start_time = perf_counter()
+        Tweets._get_collection().bulk_write(operations, ordered=False)
+        self._write_time += perf_counter() - start_time
+
+        self._bulk_writes += 1
+        self._written_tweets += len(self._pending)
+        self._written_values += sum(len(values) for values in self._pending.values())
+        self._pending = {}
+
+    def report(self) -> None:
+        """Prints how many updates were written and the write throughput"""
+        tweets_per_second = (
+            self._written_tweets / self._write_time if self._write_time else 0
+        )
+        print(
+            f"Wrote {self._written_values} attribute values for {self._written_tweets} tweets in "
+            f"{self._bulk_writes} bulk writes ({tweets_per_second:.0f} tweets/s)."
+        )
+
+
 def update_search_query(tweets_to_update: QuerySet, full_new_query: str) -> None:
     """Updates the query_parameter of the tweets
     :param tweets_to_update: The tweets for which the query_parameter should be updated
@@ -39,7 +136,10 @@ def update_search_query(tweets_to_update: QuerySet, full_new_query: str) -> None
     tweets_new_query_before_update = get_tweets_for_search_query(full_new_query)
 
     for tweet in tweets_to_update:
-        tweet.update(search_params__query=full_new_query)
+        tweet.update(
+            search_params__query=full_new_query,
+            firestorm=firestorm_for_query(full_new_query),
+        )
     updated_tweets = get_tweets_for_search_query(full_new_query)
 
     print(
@@ -49,6 +149,21 @@ def update_search_query(tweets_to_update: QuerySet, full_new_query: str) -> None
     )
 
 
+def tag_firestorms(query_dicts: dict = QUERIES) -> None:
+    """Backfills the firestorm tag for all tweets that were fetched with one of the queries (tweets that are
+    inserted with src/db/insert_json.py are tagged already)
+
+    :param query_dicts: query dicts of the firestorms whose tweets should be tagged, defaults to QUERIES
+    """
+    for key, query_dict in query_dicts.items():
+        tagged = Tweets.objects(search_params__query=query_dict["query"]).update(
+            set__firestorm=key
+        )
+        print(f"Tagged {tagged} tweets with the firestorm {key}.")
+    # the tags do not change the watermark of the firestorm cache
+    clear_firestorm_cache()
+
+
 def delete_tweets(tweets_to_delete: QuerySet) -> None:
     """Handle with care! Deletes all tweets that are passed in the database
 
@@ -64,3 +179,8 @@ def delete_tweets(tweets_to_delete: QuerySet) -> None:
         sleep(1)
     print("Deleting...")
     tweets_to_delete.delete()
+
+
+if __name__ == "__main__":
+    connect_to_mongo()
+    tag_firestorms()
@@ -1,8 +1,9 @@
-from mongoengine import QuerySet
+from mongoengine import Q, QuerySet
 from src.db.connection import connect_to_mongo
+from src.db.queried import firestorm_for_query, firestorms_matching_query
 from src.db.schemes import Tweets
-from src.db.helpers import query_set_to_df
 from datetime import datetime
+from typing import Dict, List, Sequence, Tuple
 
 
 def get_tweet_for_id(tweet_id) -> QuerySet:
@@ -15,10 +16,39 @@ def get_tweets_for_ids(tweet_ids: list[int]) -> QuerySet:
     return Tweets.objects(id__in=tweet_ids)
 
 
+def get_texts_for_ids(tweet_ids: List[int], chunk_size: int = 10000) -> Dict[int, str]:
+    """Returns the texts of the tweets with chunked $in queries (only the text is transferred)
+
+    :param tweet_ids: ids of the tweets
+    :param chunk_size: number of ids per query, defaults to 10000
+    :return: dict mapping the ids of the tweets that exist in the db to their text
+    """
+    collection = Tweets._get_collection()
+    texts = {}
+    for i in range(0, len(tweet_ids), chunk_size):
+        for tweet in collection.find(
+            {"_id": {"$in": tweet_ids[i : i + chunk_size]}}, {"text": 1}
+        ):
+            texts[tweet["_id"]] = tweet["text"]
+    return texts
+
+
+def get_tweets_for_firestorm(firestorm: str) -> QuerySet:
+    """Returns all tweets that are tagged with the firestorm (see tag_firestorms in src/db/tweet_mutations.py)
+
+    :param firestorm: name of the firestorm (key in QUERIES)
+    :return: mongoengine QuerySet that contains all tweets of the firestorm
+    """
+    return Tweets.objects(firestorm=firestorm)
+
+
 def get_tweets_for_search_query(
     query: str, full_match_required: bool = False
 ) -> QuerySet:
-    """Returns all tweets that were returned for a query that contains the specified hashtag
+    """Returns all tweets that were returned for a query that contains the specified hashtag. Tweets that are tagged
+    with a firestorm whose query matches (see QUERIES) are selected with an (indexed) equality lookup, the query itself
+    is only matched for untagged tweets (fetched with a query that is not part of QUERIES or not yet tagged by
+    tag_firestorms in src/db/tweet_mutations.py).
 
     :param query: the query (or a part of the query) that was used for fetching the tweets
     :param full_match_required: if true tweets are only returned if their query is equal to the input query, if false
@@ -26,36 +56,133 @@ def get_tweets_for_search_query(
     :return: mongoengine QuerySet that contains all tweets that were retrieved when querying for this hashtag
     """
     if full_match_required:
-        results = Tweets.objects(search_params__query=query)
+        firestorm = firestorm_for_query(query)
+        firestorms = [firestorm] if firestorm else []
+        query_match = Q(search_params__query=query)
     else:
-        results = Tweets.objects(search_params__query__icontains=query)
+        firestorms = firestorms_matching_query(query)
+        query_match = Q(search_params__query__icontains=query)
 
-    if len(results) == 0:
+    if not firestorms:
+        print(f'WARNING: Your query "{query}" is not part of QUERIES.')
+    # tagged tweets were fetched with the query of their firestorm, so only the untagged tweets have to be matched
+    # by their query (not indexed!)
+    results = Tweets.objects(
+        Q(firestorm__in=firestorms) | (Q(firestorm=None) & query_match)
+    )
+
+    # len() would load (and cache) all documents of the query set, first() only fetches a single one
+    if results.first() is None:
         print(f'WARNING: Your query "{query}" did not return any results!')
 
     return results
 
 
+def tweets_before(tweets: QuerySet, end_datetime: datetime) -> QuerySet:
+    """Restricts the tweets to those created before end_datetime (the bound is part of the db query, so it is
+    answered with the created_at indexes)
+
+    :param tweets: tweets to restrict (e.g. a firestorm, see get_tweets_for_firestorm)
+    :param end_datetime: tweets created at or after this datetime are excluded
+    :return: lazy QuerySet of the tweets created before end_datetime
+    """
+    return tweets.filter(created_at__lt=end_datetime)
+
+
+def tweets_after(tweets: QuerySet, start_datetime: datetime) -> QuerySet:
+    """Restricts the tweets to those created after start_datetime
+
+    :param tweets: tweets to restrict (e.g. a firestorm, see get_tweets_for_firestorm)
+    :param start_datetime: tweets created at or before this datetime are excluded
+    :return: lazy QuerySet of the tweets created after start_datetime
+    """
+    return tweets.filter(created_at__gt=start_datetime)
+
+
+def tweets_between(
+    tweets: QuerySet, start_datetime: datetime, end_datetime: datetime
+) -> QuerySet:
+    """Restricts the tweets to those created between start_datetime (inclusive) and end_datetime (exclusive),
+    same as the between filter in src/twitter_data/filters.py
+
+    :param tweets: tweets to restrict (e.g. a firestorm, see get_tweets_for_firestorm)
+    :param start_datetime: first datetime that is included
+    :param end_datetime: first datetime that is excluded
+    :return: lazy QuerySet of the tweets created in the time range
+    """
+    return tweets.filter(created_at__gte=start_datetime, created_at__lt=end_datetime)
+
+
 def tweets_after_date(end_datetime: datetime, query: str) -> QuerySet:
-    """Returns all tweets matching the query that occured before end_datetime - Extremely inefficient implementation!
+    """Returns all tweets matching the query that occured after end_datetime
 
-    :param end_datetime: Tweets after this datetime are excluded
+    :param end_datetime: Tweets before this datetime are excluded
     :param query: Query for the tweets that should be included
-    :return: Tweets that match the query and occured before end_datetime
-    """
-    tweets_matching_query = get_tweets_for_search_query(query)
-    # transform query_set to df and filter it
-    tweets_df = query_set_to_df(tweets_matching_query)
-    end_date_timestamp = end_datetime.timestamp() * 1000  # timestamp in ms
-    tweets_after_timestamp = tweets_df[
-        tweets_df["created_at"].apply(lambda x: x["$date"] > end_date_timestamp)
-    ]
+    :return: Tweets that match the query and occured after end_datetime
+    """
+    return tweets_after(get_tweets_for_search_query(query), end_datetime)
 
-    # Transform back to query set
-    tweets_after_timestamp_query_set = get_tweets_for_ids(
-        list(tweets_after_timestamp["_id"])
-    )
-    return tweets_after_timestamp_query_set
+
+def _time_intervall_expression(grouping_var: str) -> dict:
+    """Returns the aggregation expression that maps created_at to the start of its time intervall (same as the
+    hour/six_hour_slot columns of src.twitter_data.tweets.Tweets)"""
+    if grouping_var == "hour":
+        # german utc offsets are full hours, so truncating in utc is the same as truncating in german time
+        return {"$dateTrunc": {"date": "$created_at", "unit": "hour"}}
+    elif grouping_var == "six_hour_slot":
+        local_date = {"date": "$created_at", "timezone": "Europe/Berlin"}
+        return {
+            "$dateFromParts": {
+                "year": {"$year": local_date},
+                "month": {"$month": local_date},
+                "day": {"$dayOfMonth": local_date},
+                "hour": {
+                    "$multiply": [
+                        {"$floor": {"$divide": [{"$hour": local_date}, 6]}},
+                        6,
+                    ]
+                },
+                "timezone": "Europe/Berlin",
+            }
+        }
+    else:
+        raise ValueError(f"Cannot group tweets by {grouping_var} in the db.")
+
+
+def counts_per_time_intervall(
+    tweets: QuerySet,
+    grouping_var: str,
+    to_count: Sequence[Tuple[str, str, any]],
+    match: List[dict] = [],
+) -> List[dict]:
+    """Counts tweets per time intervall with a single aggregation in the db (requires mongo 5.0+)
+
+    :param tweets: tweets to count
+    :param grouping_var: time intervall to group by ('hour' or 'six_hour_slot')
+    :param to_count: values to count; each count is described by a tuple with three entries:
+    1. name of the count in the output (e.g. 'retweet_pct')
+    2. attribute of the tweet (e.g. 'tweet_type')
+    3. value of the attribute that should be counted (e.g. 'retweet without comment')
+    :param match: additional conditions the tweets must fulfill, defaults to []
+    :return: one dict per time intervall (ordered by time) that contains the start of the intervall (_id),
+    the total number of tweets in it (total_tweets) and a count for each entry of to_count
+    """
+    counts = {
+        name: {"$sum": {"$cond": [{"$eq": [f"${attribute}", value]}, 1, 0]}}
+        for name, attribute, value in to_count
+    }
+    pipeline = [
+        {"$match": {"$and": [tweets._query] + match}},
+        {
+            "$group": {
+                "_id": _time_intervall_expression(grouping_var),
+                "total_tweets": {"$sum": 1},
+                **counts,
+            }
+        },
+        {"$sort": {"_id": 1}},
+    ]
+    return list(tweets._document._get_collection().aggregate(pipeline))
 
 
 if __name__ == "__main__":
@@ -1,7 +1,9 @@
 import pandas as pd
 import numpy as np
+from collections import namedtuple
+from graphlib import TopologicalSorter
 from json import loads
-from typing import Dict, List
+from typing import Dict, List, Sequence, Tuple, Union
 
 from mongoengine import QuerySet
 from timebudget import timebudget
@@ -9,15 +11,25 @@ from timebudget import timebudget
 from src.db.connection import connect_to_mongo
 from src.db.helpers import query_set_to_df
 from src.db.queried import QUERIES, query_iterator
-from src.db.tweet_mutations import add_attribute_to_tweet
-from src.db.tweet_queries import get_tweet_for_id, get_tweets_for_search_query
+from src.db.tweet_mutations import BulkAttributeWriter
+from src.db.tweet_queries import (
+    get_texts_for_ids,
+    get_tweet_for_id,
+    get_tweets_for_search_query,
+)
 from src.discourse_style_metrics.discourse_stlye_metrics import (
     contains_url,
     tweet_type,
-    user_type,
 )
-from src.discourse_style_metrics.offensiveness_predict import load_model, predict_single
-from src.discourse_style_metrics.offensiveness_training import CLASS_LIST
+from src.discourse_style_metrics.classification_server import ClassificationClient
+from src.discourse_style_metrics.offensiveness_cascade import predict_cascade
+from src.discourse_style_metrics.offensiveness_predict import (
+    CLASS_LIST,
+    MAX_TOKEN_LENGTH,
+    load_model,
+    predict_in_batches,
+    predict_single,
+)
 
 
 FIVETEEN_MINS_IN_MS = 900000
@@ -26,60 +38,282 @@ HOUR_IN__MS = 3600000
 
 def fs_activity_over_time(query_set: QuerySet):
     tweets_df = query_set_to_df(query_set)
-    tweets_df["timestamp"] = tweets_df.apply(lambda x: x["created_at"]["$date"], axis=1)
+    tweets_df["timestamp"] = tweets_df["created_at"]
     tweets_df.plot.line("timestamp", "firestorm_activity")
 
 
+# each attribute declares the fields it is calculated from (which may be attributes themselves) and its scope:
+# "tweet" attributes only depend on the tweet itself, "firestorm" attributes are calculated from all tweets
+Attribute = namedtuple("Attribute", "inputs scope")
+ATTRIBUTE_GRAPH = {
+    "tweet_type": Attribute(["referenced_tweets"], "tweet"),
+    "contains_url": Attribute(["entities"], "tweet"),
+    "user_type": Attribute(["author_id"], "firestorm"),
+    "user_activity": Attribute(["author_id"], "firestorm"),
+    "firestorm_activity": Attribute(["created_at"], "firestorm"),
+    "firestorm_activity_rel": Attribute(["firestorm_activity"], "firestorm"),
+    "is_offensive": Attribute(
+        ["text", "lang", "tweet_type", "referenced_tweets"], "tweet"
+    ),
+}
+
+
+def attribute_plan(attributes: List[str]) -> List[str]:
+    """Returns the attributes and all attributes they depend on in the order in which they must be calculated
+
+    :param attributes: attributes that should be added (see ATTRIBUTE_GRAPH)
+    :return: attributes in topological order
+    """
+    sorter = TopologicalSorter()
+    to_visit = list(attributes)
+    while to_visit:
+        attribute = to_visit.pop()
+        if attribute not in ATTRIBUTE_GRAPH:
+            raise ValueError(
+                f"No known preprocessing operation exists for adding the attribute {attribute}"
+            )
+        dependencies = [
+            field
+            for field in ATTRIBUTE_GRAPH[attribute].inputs
+            if field in ATTRIBUTE_GRAPH
+        ]
+        sorter.add(attribute, *dependencies)
+        to_visit.extend(dependencies)
+    return list(sorter.static_order())
+
+
+def missing_attributes_query(attributes: List[str]) -> dict:
+    """Returns a query for all tweets that lack at least one of the attributes"""
+    return {"$or": [{attribute: {"$exists": False}} for attribute in attributes]}
+
+
+def _missing_mask(
+    tweets: QuerySet, firestorm_df: pd.DataFrame, attribute: str
+) -> pd.Series:
+    """Returns a mask of the tweets in the frame that lack the attribute in the db (stored nulls count as present,
+    same as in missing_attributes_query)"""
+    missing_ids = {
+        tweet["_id"]
+        for tweet in tweets.filter(__raw__=missing_attributes_query([attribute]))
+        .only("id")
+        .as_pymongo()
+    }
+    return firestorm_df["_id"].isin(missing_ids)
+
+
 def add_attributes_to_tweets(
-    tweets: QuerySet, attributes: List[str], overwrite: bool = False
-):
-    if "user_type" in attributes:
-        user_groups = calculate_user_groups(tweets)
+    tweets: QuerySet,
+    attributes: List[str],
+    overwrite: bool = False,
+    flush_size: int = 1000,
+    inference_batch_size: int = 64,
+    offensiveness_band: Tuple[float, float] = None,
+    client: ClassificationClient = None,
+) -> Dict[str, int]:
+    """Calculates the attributes for the tweets and writes them back to the db
+
+    :param tweets: tweets for which the attributes should be added
+    :param attributes: attributes to add (see ATTRIBUTE_GRAPH), attributes they depend on are added as well if
+    they are missing
+    :param overwrite: if true, existing values of the requested attributes are recalculated (attributes they depend on
+    are only added where they are missing), defaults to False. Attributes of the firestorm scope are recalculated for
+    all tweets if any tweet lacks them.
+    :param flush_size: number of tweets per bulk write, defaults to 1000
+    :param inference_batch_size: batch size for predicting the offensiveness, defaults to 64
+    :param offensiveness_band: if set, the offensiveness is predicted by the cascade and only tweets within the
+    uncertainty band are predicted by the transformer model (see offensiveness_cascade.py), defaults to None. The
+    model that predicted is_offensive is stored in is_offensive_stage either way.
+    :param client: if set, the offensiveness is predicted by the classification server (see classification_server.py)
+    instead of loading the model in this process, defaults to None
+    :return: dict mapping the attributes to the number of tweets for which they were added (and, if is_offensive was
+    added, the number of tweets predicted by each stage, e.g. "is_offensive_stage=linear")
+    """
+    overwritten = set(attributes) if overwrite else set()
+    # attributes that exist for all tweets are skipped (checked in the db) unless they should be overwritten
+    attributes = [
+        attribute
+        for attribute in attribute_plan(attributes)
+        if attribute in overwritten
+        or tweets.filter(__raw__=missing_attributes_query([attribute])).first()
+        is not None
+    ]
+    if not attributes:
+        print("All attributes exist for all tweets already.")
+        return {}
+    print(f"Adding the attributes {attributes}")
+
+    if not overwritten and all(
+        ATTRIBUTE_GRAPH[attribute].scope == "tweet" for attribute in attributes
+    ):
+        # only the tweets that lack an attribute are needed
+        tweets = tweets.filter(__raw__=missing_attributes_query(attributes))
+
+    # all columns that are needed for the attributes are loaded at once
+    columns = {
+        column
+        for attribute in attributes
+        for column in ATTRIBUTE_GRAPH[attribute].inputs
+    }
+    firestorm_df = query_set_to_df(tweets.only(*(columns | set(attributes))))
+    if firestorm_df.empty:
+        return {}
+    for column in columns:
+        if column not in firestorm_df:  # no tweet has a value for the column
+            firestorm_df[column] = None
+
+    if "user_type" in attributes or "user_activity" in attributes:
+        # user groups and activities are calculated from all tweets of the firestorm
+        user_attributes_df = user_attributes(firestorm_df)
+
+    updated = {}
+    for attribute in attributes:
+        if attribute in overwritten:
+            to_update = pd.Series(True, index=firestorm_df.index)
+        else:
+            to_update = _missing_mask(tweets, firestorm_df, attribute)
+        if ATTRIBUTE_GRAPH[attribute].scope == "firestorm" and (
+            to_update.any()
+            or any(field in updated for field in ATTRIBUTE_GRAPH[attribute].inputs)
+        ):
+            # values of the firestorm scope depend on all tweets (e.g. the maximum activity), so they are recalculated
+            # for the whole firestorm to keep them consistent
+            to_update = pd.Series(True, index=firestorm_df.index)
+        if not to_update.any():
+            continue
+
+        if attribute in ("user_type", "user_activity"):
+            values = user_attributes_df.loc[to_update, attribute]
+        else:
+            values = attribute_values(
+                attribute,
+                firestorm_df,
+                to_update,
+                inference_batch_size,
+                offensiveness_band,
+                client,
+            )
+        # is_offensive is calculated together with the stage that predicted it
+        values_df = (
+            values if isinstance(values, pd.DataFrame) else values.to_frame(attribute)
+        )
+        for column in values_df:
+            # calculated values are stored in the frame so that later attributes can make use of them
+            firestorm_df[column] = (
+                firestorm_df[column].astype(object) if column in firestorm_df else None
+            )
+            firestorm_df.loc[to_update, column] = values_df[column]
+            updated[column] = to_update.to_numpy()
+        print(f"Calculated {attribute} for {to_update.sum()} tweets.")
+
+    with BulkAttributeWriter(flush_size) as writer:
+        values = {attribute: firestorm_df[attribute].tolist() for attribute in updated}
+        for i, tweet_id in enumerate(firestorm_df["_id"].tolist()):
+            for attribute, to_update in updated.items():
+                if to_update[i]:
+                    value = values[attribute][i]
+                    writer.add(tweet_id, attribute, None if _is_null(value) else value)
+
+    added = {
+        attribute: int(to_update.sum()) for attribute, to_update in updated.items()
+    }
+    if "is_offensive_stage" in updated:
+        # the stage is added together with is_offensive, the routing of the cascade is summed up instead
+        stages = firestorm_df.loc[
+            updated["is_offensive_stage"], "is_offensive_stage"
+        ].value_counts()
+        del added["is_offensive_stage"]
+        added.update(
+            {
+                f"is_offensive_stage={stage}": int(count)
+                for stage, count in stages.items()
+            }
+        )
+    return added
+
+
+def attribute_values(
+    attribute: str,
+    firestorm_df: pd.DataFrame,
+    to_update: pd.Series,
+    inference_batch_size: int = 64,
+    offensiveness_band: Tuple[float, float] = None,
+    client: ClassificationClient = None,
+) -> pd.Series:
+    """Calculates an attribute column-wise
+
+    :param attribute: attribute to calculate (see ATTRIBUTE_GRAPH), user_type and user_activity are calculated by
+    user_attributes
+    :param firestorm_df: all tweets of the firestorm (containing the input columns of the attribute)
+    :param to_update: mask of the tweets for which the attribute should be calculated
+    :param inference_batch_size: batch size for predicting the offensiveness, defaults to 64
+    :param offensiveness_band: uncertainty band of the cascade (see add_attributes_to_tweets), defaults to None
+    :param client: classification server predicting the offensiveness (see add_attributes_to_tweets), defaults to None
+    :return: values of the attribute for the tweets in to_update (for is_offensive a frame that contains the
+    is_offensive_stage as well, see predict_offensiveness)
+    """
+    if attribute == "tweet_type":
+        return firestorm_df.loc[to_update, "referenced_tweets"].map(
+            lambda referenced_tweets: tweet_type(
+                {"referenced_tweets": referenced_tweets}
+            )
+        )
+    elif attribute == "contains_url":
+        # tweets without entities are missing values (None or NaN) in the frame
+        return firestorm_df.loc[to_update, "entities"].map(
+            lambda entities: contains_url(
+                {"entities": entities if isinstance(entities, dict) else {}}
+            )
+        )
+    elif attribute == "firestorm_activity":
+        timestamps = firestorm_df["created_at"].to_numpy()
+        activities = fs_activities(
+            timestamps[to_update.to_numpy()], timestamps, [HOUR_IN__MS]
+        )[HOUR_IN__MS]
+        return pd.Series(activities, index=firestorm_df.index[to_update])
+    elif attribute == "firestorm_activity_rel":
+        max_activity = firestorm_df["firestorm_activity"].max()
+        print(f"Comparing activity against max of {max_activity}")
+        return firestorm_df.loc[to_update, "firestorm_activity"] / max_activity
+    elif attribute == "is_offensive":
+        model, tokenizer = (None, None) if client else offensiveness_model()
+        tweets = _tweet_dicts(
+            firestorm_df.loc[to_update, ATTRIBUTE_GRAPH["is_offensive"].inputs]
+        )
+        referenced_texts = retweeted_texts(tweets)
+        tweet_txts = pd.Series(
+            [offensiveness_text(tweet, referenced_texts) for tweet in tweets],
+            index=firestorm_df.index[to_update],
+            dtype=object,
+        )
+        return predict_offensiveness(
+            tweet_txts,
+            model,
+            tokenizer,
+            inference_batch_size,
+            client,
+            offensiveness_band,
+        )
+    else:
+        raise ValueError(
+            f"No known preprocessing operation exists for adding the attribute {attribute}"
+        )
 
-    if "user_activity" in attributes:
-        activities_for_author = activity_per_user(tweets)
 
-    if "is_offensive" in attributes:
-        model, tokenizer = load_model("/models/german_hatespeech_detection_finetuned")
+def offensiveness_model():
+    """Returns the offensiveness model and its tokenizer (loaded once per process, see model_registry.py)"""
+    return load_model("/models/german_hatespeech_detection_finetuned")
 
-    if "firestorm_activity" in attributes:
-        timestamps_list = fs_timestamps(tweets)
 
-    if "firestorm_activity_rel" in attributes:
-        firestorm_df = query_set_to_df(tweets)
-        max_activity = firestorm_df["firestorm_activity"].max()
-        print(f"Comparing activity against max of {max_activity}")
+def _is_null(value) -> bool:
+    return value is None or (isinstance(value, float) and np.isnan(value))
 
-    for i, tweet in enumerate(tweets):
-        tweet_dict = loads(tweet.to_json())
-        if i % 1000 == 0:
-            print(f"Added attributes for {i} tweets. Continuing...")
-        for attribute in attributes:
-            if overwrite or attribute not in tweet_dict:
-                if attribute == "tweet_type":
-                    value = tweet_type(tweet_dict)
-                elif attribute == "contains_url":
-                    value = contains_url(tweet_dict)
-                elif attribute == "user_type":
-                    value = user_type(tweet_dict, user_groups)
-                elif attribute == "user_activity":
-                    value = activities_for_author[tweet_dict["author_id"]]
-                elif attribute == "firestorm_activity":
-                    value = fs_activity(
-                        tweet_dict["created_at"]["$date"],
-                        timestamps_list,
-                        HOUR_IN__MS,
-                    )
-                elif attribute == "firestorm_activity_rel":
-                    value = tweet_dict["firestorm_activity"] / max_activity
-                elif attribute == "is_offensive":
-                    value = determine_offensiveness(tweet_dict, model, tokenizer)
-                else:
-                    raise ValueError(
-                        f"No known preprocessing operation exists for adding the attribute {attribute}"
-                    )
 
-                add_attribute_to_tweet(tweet, attribute, value)
+def _tweet_dicts(tweets_df: pd.DataFrame) -> List[dict]:
+    """Returns the rows of the frame as dicts - missing values are left out (same as in the json of a tweet)"""
+    return [
+        {key: value for key, value in tweet.items() if not _is_null(value)}
+        for tweet in tweets_df.to_dict("records")
+    ]
 
 
 def activity_per_user(tweets: QuerySet) -> pd.DataFrame:
@@ -93,47 +327,57 @@ def activity_per_user(tweets: QuerySet) -> pd.DataFrame:
     return firestorms_user_activity_counts.to_dict()["count"]
 
 
-def calculate_user_groups(tweets: QuerySet) -> Dict:
-    firestorm_df = query_set_to_df(tweets)
-    print(len(firestorm_df))
-    print(firestorm_df.columns)
-    # group by author id
-    firestorms_user_activity_counts = (
-        firestorm_df.groupby(["author_id"]).size().reset_index(name="count")
-    )
-
-    firestorms_user_activity_counts.sort_values(
-        by=["count"], ascending=False, inplace=True
-    )
-
-    user_groups = {
-        "hyper_active_users": list(
-            firestorms_user_activity_counts.iloc[
-                : len(firestorms_user_activity_counts) // 100
-            ]["author_id"]
+def user_groups_for_activity(author_activity: pd.Series) -> pd.Series:
+    """Assigns the authors to user groups based on their activity: the top 1% of the authors are hyper-active, the
+    next 9% active and the rest laggards
+
+    :param author_activity: number of tweets per author (indexed by author_id)
+    :return: user type for each author (indexed by author_id)
+    """
+    author_activity = author_activity.sort_values(ascending=False)
+    rank = np.arange(len(author_activity))
+    user_groups = pd.Series(
+        np.select(
+            [rank < len(author_activity) // 100, rank < len(author_activity) // 10],
+            ["hyper-active", "active"],
+            "laggard",
         ),
-        "active_users": list(
-            firestorms_user_activity_counts.iloc[
-                len(firestorms_user_activity_counts)
-                // 100 : len(firestorms_user_activity_counts)
-                // 10
-            ]["author_id"]
-        ),
-        "lurking_users": list(
-            firestorms_user_activity_counts.iloc[
-                len(firestorms_user_activity_counts) // 10 :
-            ]["author_id"]
-        ),
-    }
+        index=author_activity.index,
+        name="user_type",
+    )
 
+    group_sizes = user_groups.value_counts()
     print(
-        f'{len(user_groups["hyper_active_users"])} hyper_active_users, {len(user_groups["active_users"])}'
-        f' active_users and {len(user_groups["lurking_users"])} lurking_users'
+        f'{group_sizes.get("hyper-active", 0)} hyper_active_users, {group_sizes.get("active", 0)}'
+        f' active_users and {group_sizes.get("laggard", 0)} lurking_users'
     )
 
     return user_groups
 
 
+def calculate_user_groups(tweets: QuerySet) -> pd.Series:
+    firestorm_df = query_set_to_df(tweets.only("author_id"))
+    return user_groups_for_activity(firestorm_df.groupby(["author_id"]).size())
+
+
+def user_attributes(firestorm_df: pd.DataFrame) -> pd.DataFrame:
+    """Calculates user_type and user_activity for all tweets with a single join of the tweets and their authors
+
+    :param firestorm_df: all tweets of the firestorm (containing the author_id)
+    :return: data frame containing the user_type and user_activity of each tweet (same index as firestorm_df)
+    """
+    author_activity = firestorm_df.groupby(["author_id"]).size()
+    authors_df = pd.DataFrame(
+        {
+            "user_activity": author_activity,
+            "user_type": user_groups_for_activity(author_activity),
+        }
+    )
+    return firestorm_df[["author_id"]].join(authors_df, on="author_id")[
+        ["user_type", "user_activity"]
+    ]
+
+
 def fs_activity(entry_timestamp: int, all_timestamps: np.array, time_span: int):
     return len(
         all_timestamps[
@@ -143,17 +387,141 @@ def fs_activity(entry_timestamp: int, all_timestamps: np.array, time_span: int):
     )
 
 
+def fs_activities(
+    entry_timestamps: np.array, all_timestamps: np.array, time_spans: Sequence[int]
+) -> Dict[int, np.array]:
+    """Vectorized version of fs_activity for many entries and time spans: the timestamps are sorted once and the
+    window boundaries are looked up with binary search (O(n log n) instead of O(n^2))
+
+    :param entry_timestamps: timestamps (ms) of the entries for which the activity should be calculated
+    :param all_timestamps: timestamps (ms) of all tweets of the firestorm
+    :param time_spans: lengths (ms) of the windows preceding the entries (e.g. HOUR_IN__MS)
+    :return: dict mapping each time span to the activity for each entry (same strict bounds as fs_activity)
+    """
+    sorted_timestamps = np.sort(all_timestamps)
+    # number of timestamps < entry_timestamp
+    before_entry = np.searchsorted(sorted_timestamps, entry_timestamps, side="left")
+    return {
+        # minus the number of timestamps <= entry_timestamp - time_span
+        time_span: before_entry
+        - np.searchsorted(sorted_timestamps, entry_timestamps - time_span, side="right")
+        for time_span in time_spans
+    }
+
+
 def normalized_fs_activity(firestorm_query_set: QuerySet):
     firestorm_df = query_set_to_df(firestorm_query_set)
     firestorm_df
 
 
 def fs_timestamps(tweets: QuerySet) -> np.array:
-    tweets_df = query_set_to_df(tweets)
-    return np.array([entry["$date"] for entry in tweets_df["created_at"]])
+    tweets_df = query_set_to_df(tweets.only("created_at"))
+    return tweets_df["created_at"].to_numpy()
+
+
+def predict_offensiveness(
+    tweet_txts: pd.Series,
+    model,
+    tokenizer,
+    batch_size: int = 64,
+    client: ClassificationClient = None,
+    band: Tuple[float, float] = None,
+) -> pd.DataFrame:
+    """Predicts the offensiveness for many tweets in batches
+
+    :param tweet_txts: texts to predict (see offensiveness_text), None for tweets without a prediction
+    :param model: model used for the prediction
+    :param tokenizer: tokenizer of the model
+    :param batch_size: number of tweets of the maximum length per forward pass (shorter tweets are predicted in larger
+    batches), defaults to 64
+    :param client: if set, the predictions are requested from the classification server instead of the model (see
+    classification_server.py), defaults to None
+    :param band: if set, only tweets within the uncertainty band of the linear model are predicted by the transformer
+    model (see offensiveness_cascade.py), defaults to None
+    :return: frame containing whether each tweet is offensive (is_offensive) and the model that predicted it
+    (is_offensive_stage, "linear" or "transformer"), both are None for tweets without a prediction
+    """
+    offensiveness_df = pd.DataFrame(
+        {"is_offensive": None, "is_offensive_stage": None},
+        index=tweet_txts.index,
+        dtype=object,
+    )
+    to_predict = tweet_txts.notna()
+
+    def predict_transformer(texts: List[str]) -> List[int]:
+        if client:
+            return client.predict(texts, batch_size=batch_size)
+        # batches of similar length with the token budget of batch_size texts of the maximum length
+        return predict_in_batches(
+            model, tokenizer, texts, max_tokens=batch_size * MAX_TOKEN_LENGTH
+        )
+
+    if band:
+        predictions, by_transformer = predict_cascade(
+            list(tweet_txts[to_predict]), predict_transformer, band
+        )
+    else:
+        predictions = predict_transformer(list(tweet_txts[to_predict]))
+        by_transformer = [True] * len(predictions)
+    offensiveness_df.loc[to_predict, "is_offensive"] = [
+        CLASS_LIST[prediction] == "OFFENSE" for prediction in predictions
+    ]
+    offensiveness_df.loc[to_predict, "is_offensive_stage"] = [
+        "transformer" if transformer else "linear" for transformer in by_transformer
+    ]
+    return offensiveness_df
 
 
 def determine_offensiveness(tweet: dict, model, tokenizer):
+    tweet_txt = offensiveness_text(tweet)
+    if tweet_txt is None:
+        return None
+    prediction = CLASS_LIST[predict_single(model, tokenizer, tweet_txt)]
+    return prediction == "OFFENSE"
+
+
+def retweeted_id(tweet: dict) -> Union[int, None]:
+    """Returns the id of the tweet that was retweeted (None if the tweet references no retweeted tweet)"""
+    for referenced_tweet in tweet.get("referenced_tweets") or []:
+        if referenced_tweet["type"] == "retweeted":
+            return referenced_tweet["id"]
+    return None
+
+
+def retweeted_texts(tweets: List[dict]) -> Dict[int, str]:
+    """Resolves the texts of all tweets that were retweeted (without comment) by german tweets at once
+
+    :param tweets: tweets as dicts (including their tweet_type)
+    :return: dict mapping the ids of the retweeted tweets to their text
+    """
+    retweeted_ids = {
+        retweeted_id(tweet)
+        for tweet in tweets
+        if tweet.get("lang") == "de"
+        and tweet.get("tweet_type") == "retweet without comment"
+    } - {None}
+    texts = get_texts_for_ids(list(retweeted_ids))
+
+    missing = len(retweeted_ids) - len(texts)
+    if missing:
+        # dirty fall back - however this occures very rarely
+        print(
+            f"Did not find {missing} of {len(retweeted_ids)} retweeted tweets. "
+            f"Falling back to the text of the retweets for them."
+        )
+    return texts
+
+
+def offensiveness_text(
+    tweet: dict, referenced_texts: Dict[int, str] = None
+) -> Union[str, None]:
+    """Returns the text for which the offensiveness of the tweet is predicted
+
+    :param tweet: tweet as dict (including its tweet_type)
+    :param referenced_texts: texts of the retweeted tweets (see retweeted_texts), if None the text of a retweeted
+    tweet is fetched from the db, defaults to None
+    :return: text to predict, None if no prediction is made for the tweet (not german)
+    """
     if "tweet_type" not in tweet:
         raise Exception(
             "The tweet does not have a tweet_type. Tweet type must be calculated for"
@@ -168,28 +536,27 @@ def determine_offensiveness(tweet: dict, model, tokenizer):
             if len(tweet["referenced_tweets"]) > 1:
                 print("\ntweet with multiple references")
                 print(tweet)
-            for referenced_tweet in tweet["referenced_tweets"]:
-                if referenced_tweet["type"] == "retweeted":
-                    retweeted_tweet_id = referenced_tweet["id"]
-                    try:
-                        tweet_txt = loads(
-                            get_tweet_for_id(retweeted_tweet_id).to_json()
-                        )["text"]
-                    except Exception:
-                        # dirty fall back - however this occures very rarely
-                        print(
-                            "Did not find a referenced tweet for this tweet. Falling back to the original tweet text."
-                        )
-                        tweet_txt = tweet["text"]
-                    break
+            retweeted_tweet_id = retweeted_id(tweet)
+            if referenced_texts is not None:
+                # missing tweets are reported by retweeted_texts
+                tweet_txt = referenced_texts.get(retweeted_tweet_id, tweet["text"])
+            else:
+                try:
+                    tweet_txt = loads(get_tweet_for_id(retweeted_tweet_id).to_json())[
+                        "text"
+                    ]
+                except Exception:
+                    # dirty fall back - however this occures very rarely
+                    print(
+                        "Did not find a referenced tweet for this tweet. Falling back to the original tweet text."
+                    )
+                    tweet_txt = tweet["text"]
         else:
             # for quoted tweets and replies,we only look at what the user wrote themselve
             # and ignore the tweet that they quoted or replied to for now
             tweet_txt = tweet["text"]
 
-        tweet_txt = tweet_txt.replace("\n", "|LBR|")
-        prediction = CLASS_LIST[predict_single(model, tokenizer, tweet_txt)]
-        return prediction == "OFFENSE"
+        return tweet_txt.replace("\n", "|LBR|")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,197 @@
+"""
+    A streaming classification pipeline in which reading the texts, tokenizing them and running the model overlap:
+    a reader thread groups the texts (e.g. from a mongo cursor or a frame) into batches, tokenizer threads tokenize
+    the batches with the batch mode of the fast tokenizers (which releases the GIL) and the model runs in the calling
+    thread. Each tokenizer thread works on its own copy of the tokenizer, because every call with padding and
+    truncation options reconfigures the underlying Rust tokenizer, which must not be shared between threads. The stages are connected by bounded queues, so the reader and the tokenizers are at most a few batches
+    ahead of the model.
+"""
+
+import copy
+import threading
+from collections import defaultdict
+from queue import Empty, Full, Queue
+from time import perf_counter
+from typing import Dict, Iterable, Iterator, List
+
+from mongoengine import QuerySet
+
+# marks the end of the batches in the queues
+_END = None
+
+
+def query_set_texts(tweets: QuerySet, field: str = "text") -> Iterator[str]:
+    """Streams the texts of the tweets from the db (only the text field is loaded)
+
+    :param tweets: tweets whose texts should be classified
+    :param field: field containing the text, defaults to "text"
+    :return: iterator over the texts (in the order of the query set)
+    """
+    for tweet in tweets.only(field).as_pymongo():
+        if tweet.get(field) is None:
+            # skipping the tweet would shift the predictions of all following tweets
+            raise ValueError(f"Tweet {tweet['_id']} has no {field}")
+        yield tweet[field]
+
+
+class _StageTimes:
+    """Sums up the seconds each stage spent working (thread safe)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.seconds = defaultdict(float)
+
+    def add(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            self.seconds[stage] += seconds
+
+
+def classify_stream(
+    texts: Iterable[str],
+    model,
+    tokenizer,
+    batch_size: int = 64,
+    tokenizer_workers: int = 2,
+    text_queue_depth: int = 8,
+    token_queue_depth: int = 4,
+    max_length: int = 64,
+    device: str = None,
+    show_timing: bool = False,
+) -> List[int]:
+    """Predicts the labels for the texts with overlapping reader, tokenizer and model stages
+
+    :param texts: texts to classify, may be a stream (see query_set_texts)
+    :param model: the model to use for prediction
+    :param tokenizer: the (fast) tokenizer used for the model
+    :param batch_size: number of texts per batch, defaults to 64
+    :param tokenizer_workers: number of tokenizer threads, defaults to 2
+    :param text_queue_depth: maximum number of batches the reader is ahead of the tokenizers, defaults to 8
+    :param token_queue_depth: maximum number of tokenized batches waiting for the model, defaults to 4
+    :param max_length: longer texts are truncated, defaults to 64
+    :param device: device the tokens are moved to (e.g. "cuda"), they stay on the cpu if None, defaults to None
+    :param show_timing: print the seconds each stage spent working, defaults to False
+    :return: list of predictions (in the order of texts)
+    """
+    import torch
+
+    text_queue = Queue(maxsize=text_queue_depth)
+    token_queue = Queue(maxsize=token_queue_depth)
+    stage_times = _StageTimes()
+    errors = []
+    # set when a stage fails, so that the other stages stop instead of waiting for each other
+    stop = threading.Event()
+
+    def put(queue: Queue, item) -> None:
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return
+            except Full:
+                pass
+
+    def get(queue: Queue):
+        while not stop.is_set():
+            try:
+                return queue.get(timeout=0.1)
+            except Empty:
+                pass
+        return _END
+
+    def read():
+        try:
+            # the tokenizers may finish batches out of order, so the batches are numbered
+            batch_number = 0
+            batch = []
+            start_time = perf_counter()
+            for text in texts:
+                batch.append(text)
+                if len(batch) == batch_size:
+                    stage_times.add("reader", perf_counter() - start_time)
+                    put(text_queue, (batch_number, batch))
+                    batch_number += 1
+                    batch = []
+                    start_time = perf_counter()
+            stage_times.add("reader", perf_counter() - start_time)
+            if batch:
+                put(text_queue, (batch_number, batch))
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            # one end marker per tokenizer thread
+            for _ in range(tokenizer_workers):
+                put(text_queue, _END)
+
+    def tokenize(worker_tokenizer):
+        try:
+            while True:
+                item = get(text_queue)
+                if item is _END:
+                    break
+                batch_number, batch = item
+                start_time = perf_counter()
+                tokens = worker_tokenizer(
+                    batch,
+                    return_tensors="pt",
+                    padding=True,
+                    truncation=True,
+                    max_length=max_length,
+                )
+                stage_times.add("tokenizer", perf_counter() - start_time)
+                put(token_queue, (batch_number, tokens))
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            put(token_queue, _END)
+
+    threads = [threading.Thread(target=read, daemon=True)] + [
+        threading.Thread(target=tokenize, args=(copy.deepcopy(tokenizer),), daemon=True)
+        for _ in range(tokenizer_workers)
+    ]
+    start_time = perf_counter()
+    for thread in threads:
+        thread.start()
+
+    predictions: Dict[int, List[int]] = {}
+    finished_tokenizers = 0
+    model.eval()
+    try:
+        with torch.no_grad():
+            while finished_tokenizers < tokenizer_workers:
+                item = get(token_queue)
+                if item is _END:
+                    finished_tokenizers += 1
+                    continue
+                batch_number, tokens = item
+                model_start_time = perf_counter()
+                if device:
+                    tokens = tokens.to(device)
+                output = model(**tokens)
+                predictions[batch_number] = output.logits.argmax(dim=1).tolist()
+                stage_times.add("model", perf_counter() - model_start_time)
+    except BaseException:
+        stop.set()
+        raise
+
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+    if show_timing:
+        total_time = perf_counter() - start_time
+        print(
+            f"Classified {sum(len(p) for p in predictions.values())} texts in {total_time:.1f}s "
+            f"(working time of the stages: "
+            + ", ".join(
+                f"{stage} {stage_times.seconds[stage]:.1f}s"
+                for stage in ["reader", "tokenizer", "model"]
+            )
+            + f", {tokenizer_workers} tokenizer threads)"
+        )
+    return [
+        prediction
+        for batch_number in sorted(predictions)
+        for prediction in predictions[batch_number]
+    ]
@@ -0,0 +1,311 @@
+"""
+    A long-running local classification server for the offensiveness model: the model is loaded once and concurrent
+    requests (e.g. of several scripts or worker processes) are merged into micro-batches. A batch is run as soon as it
+    is full or the oldest request waited for the maximum latency. Latency percentiles and a histogram of the batch
+    sizes can be requested for tuning both limits, together with the throughput per length bucket and the hits of the
+    prediction cache (nothing is printed per batch).
+
+    Endpoints (localhost HTTP, json): POST /predict {"texts": [...]} -> {"predictions": [...]}, GET /stats
+"""
+
+import copy
+import json
+import math
+import threading
+import urllib.error
+import urllib.request
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from queue import Empty, Queue
+from time import perf_counter
+from typing import Dict, List, Tuple
+
+import numpy as np
+from tqdm import tqdm
+
+from src.discourse_style_metrics.offensiveness_predict import (
+    MAX_TOKEN_LENGTH,
+    load_model,
+    predict_in_batches,
+)
+from src.discourse_style_metrics.prediction_cache import default_prediction_cache
+
+DEFAULT_ADDRESS = ("localhost", 8765)
+
+
+class _PendingRequest:
+    def __init__(self, texts: List[str]):
+        self.texts = texts
+        self.arrival_time = perf_counter()
+        self.done = threading.Event()
+        self.predictions = None
+        self.error = None
+
+
+class MicroBatcher:
+    """Merges the texts of concurrent requests into batches that are predicted by a single thread"""
+
+    def __init__(
+        self,
+        model,
+        tokenizer,
+        max_batch_size: int = 256,
+        max_latency_ms: float = 20,
+        stats_window: int = 10000,
+    ):
+        """
+        :param model: the model to use for prediction
+        :param tokenizer: the tokenizer used for the model
+        :param max_batch_size: a batch is run as soon as it contains this many texts, defaults to 256
+        :param max_latency_ms: a batch is run at the latest after its oldest request waited this long, defaults to 20
+        :param stats_window: number of latest requests the latency percentiles are calculated for, defaults to 10000
+        """
+        self.model = model
+        # the tokenizer of the model registry may be called by other threads of the process at the same time
+        self.tokenizer = copy.deepcopy(tokenizer)
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms / 1000
+        self._queue = Queue()
+        self._latencies = deque(maxlen=stats_window)
+        self._batch_sizes = Counter()
+        self._cache_stats = {"hits": 0, "misses": 0}
+        # maps the length bucket to the number of texts and the seconds needed for them (see predict_length_bucketed)
+        self._bucket_stats = {}
+        self._stats_lock = threading.Lock()
+        # the model is only used by this thread
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def predict(self, texts: List[str]) -> List[int]:
+        """Predicts the labels for the texts (blocks until the batch containing them was run)"""
+        request = _PendingRequest(texts)
+        self._queue.put(request)
+        request.done.wait()
+        if request.error:
+            raise request.error
+        return request.predictions
+
+    def _next_batch(self) -> List[_PendingRequest]:
+        batch = [self._queue.get()]
+        n_texts = len(batch[0].texts)
+        deadline = batch[0].arrival_time + self.max_latency
+        while n_texts < self.max_batch_size:
+            try:
+                request = self._queue.get(timeout=max(0, deadline - perf_counter()))
+            except Empty:
+                break
+            batch.append(request)
+            n_texts += len(request.texts)
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._next_batch()
+            texts = [text for request in batch for text in request.texts]
+            bucket_stats = {}
+            try:
+                predictions = predict_in_batches(
+                    self.model,
+                    self.tokenizer,
+                    texts,
+                    show_progress=False,
+                    max_tokens=self.max_batch_size * MAX_TOKEN_LENGTH,
+                    # reported through stats() instead of once per micro-batch
+                    report=False,
+                    bucket_stats=bucket_stats,
+                )
+            except Exception as e:
+                for request in batch:
+                    request.error = e
+                    request.done.set()
+                continue
+
+            end_time = perf_counter()
+            cache = default_prediction_cache()
+            with self._stats_lock:
+                self._cache_stats = {"hits": cache.hits, "misses": cache.misses}
+                for bucket, (n_texts, seconds) in bucket_stats.items():
+                    total = self._bucket_stats.setdefault(bucket, [0, 0.0])
+                    total[0] += n_texts
+                    total[1] += seconds
+                self._batch_sizes[len(texts)] += 1
+                self._latencies.extend(
+                    end_time - request.arrival_time for request in batch
+                )
+            start = 0
+            for request in batch:
+                request.predictions = predictions[start : start + len(request.texts)]
+                start += len(request.texts)
+                request.done.set()
+
+    def stats(self) -> Dict:
+        """Returns the latency percentiles (in ms) of the latest requests, a histogram of the batch sizes (number
+        of batches per power of two), the throughput per length bucket (of the texts that were not cached) and the
+        hits of the prediction cache"""
+        with self._stats_lock:
+            latencies = np.array(self._latencies) * 1000
+            batch_sizes = Counter()
+            for size, count in self._batch_sizes.items():
+                batch_sizes[2 ** math.ceil(math.log2(size)) if size else 0] += count
+            cache_stats = dict(self._cache_stats)
+            bucket_stats = {
+                bucket: tuple(stats) for bucket, stats in self._bucket_stats.items()
+            }
+
+        return {
+            "requests": len(latencies),
+            "latency_ms": {
+                f"p{percentile}": float(np.percentile(latencies, percentile))
+                if len(latencies)
+                else None
+                for percentile in [50, 90, 99]
+            },
+            "batch_sizes": {
+                f"<={size}": batch_sizes[size] for size in sorted(batch_sizes)
+            },
+            "length_buckets": {
+                f"<={bucket} tokens": {
+                    "texts": n_texts,
+                    "texts_per_s": n_texts / seconds if seconds else None,
+                }
+                for bucket, (n_texts, seconds) in sorted(bucket_stats.items())
+            },
+            "prediction_cache": cache_stats,
+        }
+
+
+def _handler_for(batcher: MicroBatcher):
+    class ClassificationHandler(BaseHTTPRequestHandler):
+        def _send_json(self, status: int, content: Dict) -> None:
+            body = json.dumps(content).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == "/stats":
+                self._send_json(200, batcher.stats())
+            else:
+                self._send_json(404, {"error": f"Unknown path {self.path}"})
+
+        def do_POST(self):
+            if self.path != "/predict":
+                self._send_json(404, {"error": f"Unknown path {self.path}"})
+                return
+            try:
+                request = json.loads(
+                    self.rfile.read(int(self.headers["Content-Length"]))
+                )
+                predictions = batcher.predict(request["texts"])
+            except Exception as e:
+                self._send_json(500, {"error": repr(e)})
+                return
+            self._send_json(200, {"predictions": predictions})
+
+        def log_message(self, format, *args):
+            # requests are not logged individually, see /stats
+            pass
+
+    return ClassificationHandler
+
+
+def serve(
+    model_filename: str = "/models/german_hatespeech_detection_finetuned",
+    address: Tuple[str, int] = DEFAULT_ADDRESS,
+    max_batch_size: int = 256,
+    max_latency_ms: float = 20,
+) -> None:
+    """Loads the model and serves predictions until interrupted
+
+    :param model_filename: filepath to the folder of the model (see load_model)
+    :param address: host and port the server listens on, defaults to DEFAULT_ADDRESS
+    :param max_batch_size: see MicroBatcher, defaults to 256
+    :param max_latency_ms: see MicroBatcher, defaults to 20
+    """
+    model, tokenizer = load_model(model_filename)
+    batcher = MicroBatcher(model, tokenizer, max_batch_size, max_latency_ms)
+    server = ThreadingHTTPServer(address, _handler_for(batcher))
+    print(f"Serving {model_filename} on http://{address[0]}:{address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(f"Stopping server, stats: {batcher.stats()}")
+    finally:
+        server.server_close()
+
+
+class ClassificationClient:
+    """Requests predictions from a running classification server (see serve)"""
+
+    def __init__(
+        self, address: Tuple[str, int] = DEFAULT_ADDRESS, timeout: float = 600
+    ):
+        """
+        :param address: host and port of the server, defaults to DEFAULT_ADDRESS
+        :param timeout: seconds to wait for a response, defaults to 600
+        """
+        self.url = f"http://{address[0]}:{address[1]}"
+        self.timeout = timeout
+
+    def _request(self, path: str, content: Dict = None) -> Dict:
+        data = json.dumps(content).encode() if content is not None else None
+        request = urllib.request.Request(
+            self.url + path, data=data, headers={"Content-Type": "application/json"}
+        )
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            return json.loads(response.read())
+
+    def is_available(self) -> bool:
+        """Checks whether a server is running at the address"""
+        try:
+            urllib.request.urlopen(self.url + "/stats", timeout=1).close()
+            return True
+        except (urllib.error.URLError, ConnectionError, TimeoutError):
+            return False
+
+    def stats(self) -> Dict:
+        """Returns the latency percentiles and the batch size histogram of the server (see MicroBatcher.stats)"""
+        return self._request("/stats")
+
+    def predict(
+        self,
+        dataset: List[str],
+        batch_size: int = 64,
+        show_progress: bool = True,
+        concurrent_requests: int = 4,
+    ) -> List[int]:
+        """Predicts the labels for the entries in dataset with the model of the server (see predict_in_batches in
+        offensiveness_predict.py)
+
+        :param dataset: the values to predict
+        :param batch_size: number of texts per request, defaults to 64
+        :param show_progress: show a progress bar for the requests, defaults to True
+        :param concurrent_requests: number of requests that are sent at once (and may be merged by the server),
+        defaults to 4
+        :return: list of predictions for dataset
+        """
+        chunks = [
+            dataset[i : i + batch_size] for i in range(0, len(dataset), batch_size)
+        ]
+        with ThreadPoolExecutor(max_workers=concurrent_requests) as executor:
+            responses = list(
+                tqdm(
+                    executor.map(
+                        lambda chunk: self._request("/predict", {"texts": chunk}),
+                        chunks,
+                    ),
+                    total=len(chunks),
+                    disable=not show_progress,
+                )
+            )
+        return [
+            prediction
+            for response in responses
+            for prediction in response["predictions"]
+        ]
+
+
+if __name__ == "__main__":
+    serve()
@@ -7,14 +7,16 @@ def contains_url(tweet: dict) -> bool:
     return "urls" in tweet["entities"]
 
 
-def user_type(tweet: dict, user_groups: dict) -> str:
-    if tweet["author_id"] in user_groups["hyper_active_users"]:
-        return "hyper-active"
-    elif tweet["author_id"] in user_groups["active_users"]:
-        return "active"
-    elif tweet["author_id"] in user_groups["lurking_users"]:
-        return "laggard"
-    else:
+def user_type(tweet: dict, user_groups) -> str:
+    """Returns the user type of the tweets author
+
+    :param tweet: Full tweet object
+    :param user_groups: mapping of author ids to their user type (see calculate_user_groups)
+    :return: Type of the user ('hyper-active', 'active' or 'laggard')
+    """
+    try:
+        return user_groups[tweet["author_id"]]
+    except KeyError:
         raise Exception(
             f'Tweet from author {tweet["author_id"]} cannot be matched to any user'
             f"group because this author is not in any usage group"
@@ -0,0 +1,125 @@
+"""
+    A process-wide registry for the classification models: each model and its tokenizer is loaded only once per
+    process, when it is first requested. Weights that were converted to safetensors (see convert_to_safetensors) are
+    memory-mapped instead of being read into memory, so worker processes loading the same model share the pages of
+    the weight file and loading it again (e.g. in the next script) mostly hits the page cache.
+    torch and transformers are only imported when the first model is loaded.
+"""
+
+import os
+import threading
+from time import perf_counter
+from typing import Dict, Tuple
+
+SAFETENSORS_FILENAME = "model.safetensors"
+
+_models: Dict[str, Tuple] = {}
+_lock = threading.Lock()
+
+
+def resolve_model_path(model_filename: str) -> str:
+    """Returns the absolute path of the model folder (model_filename is relative to the working directory)"""
+    return os.path.realpath(os.getcwd() + model_filename)
+
+
+def resident_memory_mb() -> float:
+    """Returns the resident memory of the current process in MB"""
+    import psutil
+
+    return psutil.Process().memory_info().rss / 1024**2
+
+
+def _supports_assign() -> bool:
+    """Checks whether load_state_dict can assign (memory-mapped) tensors, which needs torch>=2.1"""
+    import torch
+
+    major, minor = torch.__version__.split(".")[:2]
+    return (int(major), int(minor)) >= (2, 1)
+
+
+def _load(model_path: str) -> Tuple:
+    from transformers import (
+        AutoConfig,
+        AutoModelForSequenceClassification,
+        AutoTokenizer,
+    )
+
+    start_time = perf_counter()
+    memory_before = resident_memory_mb()
+
+    tokenizer = AutoTokenizer.from_pretrained(model_path)
+    weights_file = os.path.join(model_path, SAFETENSORS_FILENAME)
+    if os.path.exists(weights_file) and _supports_assign():
+        from safetensors.torch import load_file
+
+        model = AutoModelForSequenceClassification.from_config(
+            AutoConfig.from_pretrained(model_path)
+        )
+        # assign keeps the memory-mapped tensors instead of copying them into the initialized parameters
+        model.load_state_dict(load_file(weights_file), assign=True)
+        weight_format = "memory-mapped safetensors"
+    else:
+        model = AutoModelForSequenceClassification.from_pretrained(model_path)
+        weight_format = (
+            "pytorch checkpoint, memory-mapping the safetensors needs torch>=2.1"
+            if os.path.exists(weights_file)
+            else "pytorch checkpoint, see convert_to_safetensors"
+        )
+    model.eval()
+
+    print(
+        f"Loaded {model_path} ({weight_format}) in {perf_counter() - start_time:.2f}s, "
+        f"resident memory {memory_before:.0f} MB -> {resident_memory_mb():.0f} MB"
+    )
+    return model, tokenizer
+
+
+def get_model(
+    model_filename: str = "/models/german_hatespeech_detection_finetuned",
+) -> Tuple:
+    """Returns the model and its tokenizer, loading them on the first request in this process
+
+    :param model_filename: filepath to the folder of the model (relative to the working directory)
+    :return: A tuple of (1) the model and (2) the respective tokenizer
+    """
+    model_path = resolve_model_path(model_filename)
+    with _lock:
+        if model_path not in _models:
+            _models[model_path] = _load(model_path)
+        return _models[model_path]
+
+
+def convert_to_safetensors(model_filename: str) -> str:
+    """Stores the weights of the model as safetensors next to the pytorch checkpoint (get_model prefers them)
+
+    :param model_filename: filepath to the folder of the model (relative to the working directory)
+    :return: path of the safetensors file
+    """
+    from safetensors.torch import save_model
+    from transformers import AutoModelForSequenceClassification
+
+    model_path = resolve_model_path(model_filename)
+    model = AutoModelForSequenceClassification.from_pretrained(model_path)
+    weights_file = os.path.join(model_path, SAFETENSORS_FILENAME)
+    save_model(model, weights_file)
+    print(
+        f"Converted the weights of {model_path} ({os.path.getsize(weights_file) / 1024 ** 2:.0f} MB)"
+    )
+    return weights_file
+
+
+def registry_report() -> None:
+    """Prints the loaded models and the resident memory of the process"""
+    print(
+        f"Loaded models: {list(_models) or 'none'}, resident memory {resident_memory_mb():.0f} MB"
+    )
+
+
+if __name__ == "__main__":
+    convert_to_safetensors("/models/german_hatespeech_detection_finetuned")
+
+    start_time = perf_counter()
+    get_model()
+    get_model()
+    print(f"Two requests for the model took {perf_counter() - start_time:.2f}s")
+    registry_report()
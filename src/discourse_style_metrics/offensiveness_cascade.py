@@ -0,0 +1,247 @@
+"""
+    A two-stage cascade for predicting the offensiveness: a cheap linear model (hashed character n-grams, tf-idf and
+    logistic regression, trained on the GermEval files) scores all texts first and only texts whose probability of
+    being offensive lies in an uncertainty band are predicted by the transformer model.
+    evaluate_cascade compares the F-Score of several bands with the transformer model alone on a labeled sample.
+"""
+
+import hashlib
+import os
+from time import perf_counter
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from src.discourse_style_metrics.offensiveness_predict import (
+    CLASS_LIST,
+    MAX_TOKEN_LENGTH,
+    load_model,
+    predict_in_batches,
+)
+from src.utils.output_folders import DATA_CACHE_FOLDER
+
+LINEAR_MODEL_FOLDER = DATA_CACHE_FOLDER + "offensiveness_linear_models/"
+GERMEVAL_FILES = [
+    "/data/offensiveness_training_data/germeval2018.test_.txt",
+    "/data/offensiveness_training_data/germeval2018.training.txt",
+    "/data/offensiveness_training_data/germeval2019.training_subtask1_2_korrigiert.txt",
+]
+# texts with a probability of being offensive within the band are predicted by the transformer model
+DEFAULT_BAND = (0.2, 0.8)
+
+
+def train_linear_model(train_files: List[str] = GERMEVAL_FILES):
+    """Trains the linear model of the first stage on the GermEval files
+
+    :param train_files: training files (relative to the working directory), defaults to GERMEVAL_FILES
+    :return: the fitted sklearn pipeline
+    """
+    from sklearn.feature_extraction.text import HashingVectorizer, TfidfTransformer
+    from sklearn.linear_model import LogisticRegression
+    from sklearn.pipeline import make_pipeline
+
+    from src.discourse_style_metrics.offensiveness_training import read_germeval_data
+
+    train_data = read_germeval_data(
+        [os.getcwd() + train_file for train_file in train_files], CLASS_LIST
+    )
+    pipeline = make_pipeline(
+        # no vocabulary has to be stored, the hashed features are weighted by tf-idf
+        HashingVectorizer(
+            analyzer="char_wb",
+            ngram_range=(2, 5),
+            n_features=2**20,
+            alternate_sign=False,
+            lowercase=True,
+        ),
+        TfidfTransformer(sublinear_tf=True),
+        LogisticRegression(max_iter=1000, class_weight="balanced"),
+    )
+    start_time = perf_counter()
+    pipeline.fit(list(train_data["text"]), list(train_data["label"]))
+    print(
+        f"Trained the linear model on {len(train_data)} texts in {perf_counter() - start_time:.1f}s"
+    )
+    return pipeline
+
+
+def linear_model_file(train_files: List[str] = GERMEVAL_FILES) -> str:
+    """Returns the file the linear model is stored in, keyed by the content of the training files and the sklearn
+    version (models trained on other data or pickled by another sklearn version are never loaded)
+
+    :param train_files: training files (relative to the working directory), defaults to GERMEVAL_FILES
+    :return: path of the joblib file
+    """
+    import sklearn
+
+    key = hashlib.sha1(sklearn.__version__.encode())
+    for train_file in train_files:
+        key.update(train_file.encode())
+        with open(os.getcwd() + train_file, "rb") as f:
+            key.update(hashlib.sha1(f.read()).digest())
+    return f"{LINEAR_MODEL_FOLDER}{key.hexdigest()}.joblib"
+
+
+# maps the file of each loaded linear model to the model
+_linear_models: Dict[str, object] = {}
+
+
+def linear_model(retrain: bool = False, train_files: List[str] = GERMEVAL_FILES):
+    """Returns the linear model of the first stage (trained once and stored in linear_model_file)
+
+    :param retrain: if true, the model is trained again even if it was stored before, defaults to False
+    :param train_files: training files (relative to the working directory), defaults to GERMEVAL_FILES
+    :return: the fitted sklearn pipeline
+    """
+    import joblib
+
+    model_file = linear_model_file(train_files)
+    if retrain or model_file not in _linear_models:
+        if not retrain and os.path.exists(model_file):
+            _linear_models[model_file] = joblib.load(model_file)
+        else:
+            _linear_models[model_file] = train_linear_model(train_files)
+            os.makedirs(LINEAR_MODEL_FOLDER, exist_ok=True)
+            # write to a temporary file first (one per process, e.g. for the workers of parallel_enrichment.py) so
+            # that other processes never load a partially written model
+            temporary_file = f"{model_file}.{os.getpid()}.tmp"
+            joblib.dump(_linear_models[model_file], temporary_file)
+            os.replace(temporary_file, model_file)
+    return _linear_models[model_file]
+
+
+def offense_probabilities(texts: List[str], pipeline=None) -> np.ndarray:
+    """Returns the probability of each text being offensive according to the linear model
+
+    :param texts: texts to score
+    :param pipeline: the linear model, defaults to linear_model()
+    :return: array of probabilities
+    """
+    if pipeline is None:
+        pipeline = linear_model()
+    offense_column = list(pipeline.classes_).index(CLASS_LIST.index("OFFENSE"))
+    return pipeline.predict_proba(texts)[:, offense_column]
+
+
+def cascade_predictions(
+    probabilities: np.ndarray, band: Tuple[float, float]
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns the predictions of the first stage and the mask of the texts that are routed to the second stage
+
+    :param probabilities: probabilities of the texts being offensive (see offense_probabilities)
+    :param band: lower and upper probability of the uncertainty band
+    :return: Tuple of (1) the predictions (index in CLASS_LIST) and (2) mask of the uncertain texts
+    """
+    lower, upper = band
+    uncertain = (probabilities >= lower) & (probabilities <= upper)
+    predictions = np.where(
+        probabilities > upper, CLASS_LIST.index("OFFENSE"), CLASS_LIST.index("OTHER")
+    )
+    return predictions, uncertain
+
+
+def predict_cascade(
+    texts: List[str],
+    predict_uncertain: Callable[[List[str]], List[int]],
+    band: Tuple[float, float] = DEFAULT_BAND,
+) -> Tuple[List[int], List[bool]]:
+    """Predicts the labels for the texts with the linear model and the uncertain texts with the second stage
+
+    :param texts: the values to predict
+    :param predict_uncertain: predicts the labels for a list of texts (e.g. predict_in_batches with the transformer
+    model or ClassificationClient.predict)
+    :param band: lower and upper probability of being offensive of the texts routed to the second stage, defaults to
+    DEFAULT_BAND
+    :return: Tuple of (1) list of predictions for texts and (2) whether each text was predicted by the second stage
+    """
+    if not texts:
+        return [], []
+    predictions, uncertain = cascade_predictions(offense_probabilities(texts), band)
+    uncertain_texts = [text for text, routed in zip(texts, uncertain) if routed]
+    if uncertain_texts:
+        predictions[uncertain] = predict_uncertain(uncertain_texts)
+    return predictions.tolist(), uncertain.tolist()
+
+
+def evaluate_cascade(
+    model,
+    tokenizer,
+    labeled_tweets: pd.DataFrame,
+    bands: List[Tuple[float, float]] = [
+        (0.4, 0.6),
+        (0.3, 0.7),
+        (0.2, 0.8),
+        (0.1, 0.9),
+        (0.05, 0.95),
+    ],
+    batch_size: int = 64,
+) -> pd.DataFrame:
+    """Compares the cascade for several uncertainty bands with the transformer model alone
+
+    :param model: the transformer model
+    :param tokenizer: the tokenizer used for the model
+    :param labeled_tweets: tweets with columns text and label (index in CLASS_LIST)
+    :param bands: uncertainty bands to compare
+    :param batch_size: batch size of the transformer model (see predict_offensiveness), defaults to 64
+    :return: DataFrame containing the F-Score, the share of texts routed to the transformer model and the (estimated)
+    prediction time for each band
+    """
+    from sklearn.metrics import f1_score
+
+    texts = list(labeled_tweets.text)
+    y_true = list(labeled_tweets.label)
+
+    start_time = perf_counter()
+    transformer_predictions = np.array(
+        predict_in_batches(
+            model,
+            tokenizer,
+            texts,
+            use_cache=False,
+            max_tokens=batch_size * MAX_TOKEN_LENGTH,
+        )
+    )
+    transformer_time = perf_counter() - start_time
+
+    start_time = perf_counter()
+    probabilities = offense_probabilities(texts)
+    linear_time = perf_counter() - start_time
+
+    results = [
+        {
+            "band": "transformer only",
+            "f1": f1_score(y_true, transformer_predictions, average="macro"),
+            "routed_to_transformer": 1.0,
+            "seconds": transformer_time,
+        }
+    ]
+    for band in bands:
+        predictions, uncertain = cascade_predictions(probabilities, band)
+        # the transformer predictions are the same as in the cascade, its time is estimated by the routed share
+        predictions[uncertain] = transformer_predictions[uncertain]
+        results.append(
+            {
+                "band": str(band),
+                "f1": f1_score(y_true, predictions, average="macro"),
+                "routed_to_transformer": uncertain.mean(),
+                "seconds": linear_time + uncertain.mean() * transformer_time,
+            }
+        )
+
+    results_df = pd.DataFrame(results).set_index("band")
+    results_df["speedup"] = transformer_time / results_df["seconds"]
+    print(results_df)
+    return results_df
+
+
+if __name__ == "__main__":
+    model, tokenizer = load_model("/models/german_hatespeech_detection_finetuned")
+    linear_model(retrain=True)
+
+    filepath_labeled_data = os.getcwd() + "/data/aggr_sample/aggregated_labels.csv"
+    test_data_df = pd.read_csv(filepath_labeled_data, sep="\t")
+    test_data_df["label"] = test_data_df.apply(
+        lambda x: CLASS_LIST.index(x["label"]), axis=1
+    )
+    evaluate_cascade(model, tokenizer, test_data_df)
@@ -0,0 +1,197 @@
+"""
+    Exports the fine-tuned offensiveness model to ONNX (optionally with dynamic int8 quantization) and runs it with
+    ONNX Runtime on the CPU. The loaded model can be passed to predict_single/predict_in_batches in place of the
+    PyTorch model.
+"""
+
+import hashlib
+import os
+from collections import namedtuple
+from time import perf_counter
+from typing import Dict
+
+import numpy as np
+import onnxruntime
+import pandas as pd
+import torch
+from onnxruntime.quantization import QuantType, quantize_dynamic
+from transformers import AutoTokenizer
+
+from src.discourse_style_metrics.offensiveness_predict import (
+    CLASS_LIST,
+    evaluate_model,
+    load_model,
+    predict_in_batches,
+)
+
+ONNX_MODEL_FILENAME = "model.onnx"
+QUANTIZED_ONNX_MODEL_FILENAME = "model.int8.onnx"
+
+# same attribute as the output of the transformers models, so the predict functions work unchanged
+OnnxOutput = namedtuple("OnnxOutput", "logits")
+
+
+class OnnxSequenceClassifier:
+    """Runs an exported sequence classification model with ONNX Runtime"""
+
+    def __init__(self, onnx_filename: str, threads: int = None):
+        """
+        :param onnx_filename: file of the exported model
+        :param threads: number of threads used by ONNX Runtime, defaults to the number of cores
+        """
+        session_options = onnxruntime.SessionOptions()
+        if threads:
+            session_options.intra_op_num_threads = threads
+        self._session = onnxruntime.InferenceSession(
+            onnx_filename, session_options, providers=["CPUExecutionProvider"]
+        )
+        self._input_names = [
+            model_input.name for model_input in self._session.get_inputs()
+        ]
+
+    def eval(self):
+        return self
+
+    def __call__(self, **tokens) -> OnnxOutput:
+        inputs = {
+            name: tokens[name].numpy().astype(np.int64) for name in self._input_names
+        }
+        (logits,) = self._session.run(["logits"], inputs)
+        return OnnxOutput(torch.from_numpy(logits))
+
+
+def export_onnx(model_filename: str, output_folder: str, quantize: bool = True) -> str:
+    """Exports the model to ONNX and stores it together with its tokenizer
+
+    :param model_filename: filepath to the folder of the PyTorch model (relative to the working directory, see
+    load_model)
+    :param output_folder: folder the ONNX model is written to (relative to the working directory)
+    :param quantize: if true, a dynamically int8 quantized version of the model is written as well, defaults to True
+    :return: path to the exported (quantized if quantize is true) model
+    """
+    model, tokenizer = load_model(model_filename)
+    model.eval()
+
+    output_folder = os.getcwd() + output_folder
+    os.makedirs(output_folder, exist_ok=True)
+    onnx_filename = os.path.join(output_folder, ONNX_MODEL_FILENAME)
+
+    sample_tokens = tokenizer(
+        ["Das ist ein Beispiel"], return_tensors="pt", padding=True, truncation=True
+    )
+    dynamic_axes = {"input_ids": {0: "batch", 1: "sequence"}}
+    dynamic_axes["attention_mask"] = dynamic_axes["input_ids"]
+    dynamic_axes["logits"] = {0: "batch"}
+    # the logits are returned as a plain tensor instead of the model output object (the model is shared through the
+    # model registry, so the previous config is restored afterwards)
+    return_dict = model.config.return_dict
+    model.config.return_dict = False
+    try:
+        torch.onnx.export(
+            model,
+            (sample_tokens["input_ids"], sample_tokens["attention_mask"]),
+            onnx_filename,
+            input_names=["input_ids", "attention_mask"],
+            output_names=["logits"],
+            dynamic_axes=dynamic_axes,
+            opset_version=13,
+        )
+    finally:
+        model.config.return_dict = return_dict
+    tokenizer.save_pretrained(output_folder)
+    print(f"Exported the model to {onnx_filename}")
+
+    if not quantize:
+        return onnx_filename
+
+    quantized_filename = os.path.join(output_folder, QUANTIZED_ONNX_MODEL_FILENAME)
+    quantize_dynamic(onnx_filename, quantized_filename, weight_type=QuantType.QInt8)
+    print(f"Exported the quantized model to {quantized_filename}")
+    return quantized_filename
+
+
+def load_onnx_model(model_folder: str, quantized: bool = True, threads: int = None):
+    """Loads an exported model with ONNX Runtime (same interface as load_model)
+
+    :param model_folder: folder of the exported model (relative to the working directory, see export_onnx)
+    :param quantized: if true, the quantized model is loaded, defaults to True
+    :param threads: number of threads used by ONNX Runtime, defaults to the number of cores
+    :return: A tuple of (1) the model and (2) the respective tokenizer
+    """
+    model_folder = os.getcwd() + model_folder
+    onnx_filename = os.path.join(
+        model_folder,
+        QUANTIZED_ONNX_MODEL_FILENAME if quantized else ONNX_MODEL_FILENAME,
+    )
+    model = OnnxSequenceClassifier(onnx_filename, threads)
+    tokenizer = AutoTokenizer.from_pretrained(model_folder)
+
+    # predictions of the exported model are cached separately from the PyTorch model (see prediction_cache.py)
+    with open(onnx_filename, "rb") as f:
+        model._prediction_cache_fingerprint = hashlib.sha1(
+            f.read() + str(sorted(tokenizer.get_vocab().items())).encode()
+        ).hexdigest()
+    return model, tokenizer
+
+
+def compare_onnx_to_pytorch(
+    model_filename: str,
+    onnx_folder: str,
+    labeled_tweets: pd.DataFrame,
+    quantized: bool = True,
+    max_f1_drop: float = 0.01,
+) -> Dict[str, float]:
+    """Checks that the exported model is as accurate as the PyTorch model (see evaluate_model) and compares the time
+    both models need for predicting the labeled tweets
+
+    :param model_filename: filepath to the folder of the PyTorch model (see load_model)
+    :param onnx_folder: folder of the exported model (see load_onnx_model)
+    :param labeled_tweets: tweets with columns text and label (index in CLASS_LIST)
+    :param quantized: if true, the quantized model is compared, defaults to True
+    :param max_f1_drop: largest acceptable drop of the macro F-Score, defaults to 0.01
+    :return: dict containing the F-Scores, the prediction times and the share of equal predictions of both models
+    """
+    results = {}
+    predictions = {}
+    for backend, (model, tokenizer) in [
+        ("pytorch", load_model(model_filename)),
+        ("onnx", load_onnx_model(onnx_folder, quantized=quantized)),
+    ]:
+        print(f"=====EVALUATING {backend}")
+        results[f"{backend}_f1"] = evaluate_model(
+            model, tokenizer, labeled_tweets, CLASS_LIST, use_cache=False
+        )
+
+        start_time = perf_counter()
+        predictions[backend] = predict_in_batches(
+            model, tokenizer, list(labeled_tweets.text), batch_size=64, use_cache=False
+        )
+        results[f"{backend}_seconds"] = perf_counter() - start_time
+
+    results["agreement"] = float(
+        np.mean(np.array(predictions["pytorch"]) == np.array(predictions["onnx"]))
+    )
+    print(
+        f"F-Score (macro): {results['pytorch_f1']:.4f} (pytorch) vs. {results['onnx_f1']:.4f} (onnx), "
+        f"{results['agreement']:.1%} equal predictions, "
+        f"{results['pytorch_seconds'] / results['onnx_seconds']:.1f}x faster "
+        f"({results['pytorch_seconds']:.1f}s vs. {results['onnx_seconds']:.1f}s)"
+    )
+    if results["pytorch_f1"] - results["onnx_f1"] > max_f1_drop:
+        print(
+            f"WARNING: The F-Score of the exported model dropped by more than {max_f1_drop}!"
+        )
+    return results
+
+
+if __name__ == "__main__":
+    model_filename = "/models/german_hatespeech_detection_finetuned"
+    onnx_folder = "/models/german_hatespeech_detection_finetuned_onnx"
+    export_onnx(model_filename, onnx_folder)
+
+    filepath_labeled_data = os.getcwd() + "/data/aggr_sample/aggregated_labels.csv"
+    test_data_df = pd.read_csv(filepath_labeled_data, sep="\t")
+    test_data_df["label"] = test_data_df.apply(
+        lambda x: CLASS_LIST.index(x["label"]), axis=1
+    )
+    compare_onnx_to_pytorch(model_filename, onnx_folder, test_data_df)
@@ -1,72 +1,252 @@
 import os
-from collections import Counter
-from typing import List, Tuple
+from collections import Counter, defaultdict
+from time import perf_counter
+from typing import TYPE_CHECKING, Dict, List, Tuple
 
 import pandas as pd
-import torch
-import transformers
-from sklearn.metrics import classification_report, precision_recall_fscore_support
-from sklearn.model_selection import train_test_split
-from timebudget import timebudget
-from torch.utils.data import DataLoader
-from tqdm import tqdm
-from transformers import AutoModelForSequenceClassification, AutoTokenizer
-from transformers.models.distilbert.modeling_distilbert import (
-    DistilBertForSequenceClassification,
-)
-from transformers.models.distilbert.tokenization_distilbert_fast import (
-    DistilBertTokenizerFast,
-)
 
-from src.discourse_style_metrics.offensiveness_training import (
-    CLASS_LIST,
-    read_germeval_data,
+from src.discourse_style_metrics.classification_pipeline import classify_stream
+from src.discourse_style_metrics.model_registry import get_model
+from src.discourse_style_metrics.prediction_cache import (
+    default_prediction_cache,
+    model_fingerprint,
 )
 
+# torch, transformers, sklearn and tqdm are imported where they are needed, so importing this module is fast
+if TYPE_CHECKING:
+    import transformers
+    from transformers.models.distilbert.modeling_distilbert import (
+        DistilBertForSequenceClassification,
+    )
+    from transformers.models.distilbert.tokenization_distilbert_fast import (
+        DistilBertTokenizerFast,
+    )
+
+CLASS_LIST = ["OFFENSE", "OTHER"]
+
+# longer texts are truncated by the tokenizer
+MAX_TOKEN_LENGTH = 64
+
 
 def load_model(
     model_filename: str,
-) -> Tuple[DistilBertForSequenceClassification, DistilBertTokenizerFast]:
-    """Loads the model from the specified filename
+) -> Tuple["DistilBertForSequenceClassification", "DistilBertTokenizerFast"]:
+    """Loads the model from the specified filename (once per process, see model_registry.py)
 
     :param model_filename: filepath to folder in which the model
     :return: A tuple of (1) the model loaded from the file path and (2) the respective tokenizer
     """
-    model_filename = os.getcwd() + model_filename
-    model = AutoModelForSequenceClassification.from_pretrained(model_filename)
-    tokenizer = AutoTokenizer.from_pretrained(model_filename)
-    return model, tokenizer
+    return get_model(model_filename)
+
+
+def predict_single(
+    model: "transformers.models", tokenizer, text: str, use_cache: bool = True
+) -> int:
+    import torch
 
+    if use_cache:
+        cache = default_prediction_cache()
+        fingerprint = model_fingerprint(model, tokenizer)
+        cached = cache.get_many(fingerprint, [text])
+        if text in cached:
+            return cached[text]
 
-def predict_single(model: transformers.models, tokenizer, text: str) -> int:
     token = tokenizer(
-        [text], return_tensors="pt", padding=True, truncation=True, max_length=64
+        [text],
+        return_tensors="pt",
+        padding=True,
+        truncation=True,
+        max_length=MAX_TOKEN_LENGTH,
     )
-    output = model(**token)
-    return int(output.logits.argmax(dim=1))
+    with torch.no_grad():
+        output = model(**token)
+    prediction = int(output.logits.argmax(dim=1))
+
+    if use_cache:
+        cache.put_many(fingerprint, {text: prediction})
+    return prediction
 
 
 def predict_in_batches(
-    model: transformers.models, tokenizer, dataset: List[str], batch_size: int = 4
+    model: "transformers.models",
+    tokenizer,
+    dataset: List[str],
+    batch_size: int = 4,
+    show_progress: bool = True,
+    use_cache: bool = True,
+    max_tokens: int = None,
+    tokenizer_workers: int = None,
+    report: bool = True,
+    bucket_stats: Dict[int, List] = None,
 ) -> List[int]:
     """Predicts the labels for the entries in dataset using the model passed
     :param model: the model to use for prediction
     :param tokenizer: the tokenizer used for the model
     :param dataset: the values to predict
     :param batch_size: batch size for DataLoader (must be same as for model?)
+    :param show_progress: show a progress bar for the batches, defaults to True
+    :param use_cache: if true, cached predictions are reused and only texts that were not predicted by the model
+    before are run through it once (see src/discourse_style_metrics/prediction_cache.py), defaults to True
+    :param max_tokens: if set, the texts are batched by their tokenized length so that each (padded) batch contains
+    at most max_tokens tokens instead of batch_size texts (see predict_length_bucketed), defaults to None
+    :param tokenizer_workers: if set (and max_tokens is not), the batches are tokenized by that many threads while the
+    model runs (see src/discourse_style_metrics/classification_pipeline.py), defaults to None
+    :param report: print the hit rate of the prediction cache and the throughput per length bucket (or the
+    timing of the pipeline stages if tokenizer_workers is set), defaults to True
+    :param bucket_stats: texts and seconds per length bucket are added to it if max_tokens is set (see
+    predict_length_bucketed), defaults to None
     :return: list of predictions for dataset
     """
-    y_pred = []
+    if use_cache:
+        cache = default_prediction_cache()
+        fingerprint = model_fingerprint(model, tokenizer)
+        predictions = cache.get_many(fingerprint, dataset)
+        # duplicated texts are only predicted once
+        to_predict = list(dict.fromkeys(x for x in dataset if x not in predictions))
+    else:
+        to_predict = dataset
+
+    if not to_predict:  # e.g. all texts were cached
+        y_pred = []
+    elif max_tokens:
+        y_pred = predict_length_bucketed(
+            model,
+            tokenizer,
+            to_predict,
+            max_tokens,
+            show_progress,
+            report=report,
+            bucket_stats=bucket_stats,
+        )
+    elif tokenizer_workers:
+        y_pred = classify_stream(
+            to_predict,
+            model,
+            tokenizer,
+            batch_size=batch_size,
+            tokenizer_workers=tokenizer_workers,
+            max_length=MAX_TOKEN_LENGTH,
+            show_timing=report,
+        )
+    else:
+        import torch
+        from torch.utils.data import DataLoader
+        from tqdm import tqdm
+
+        y_pred = []
+        with torch.no_grad():
+            model.eval()
+            for batch in tqdm(
+                DataLoader(to_predict, batch_size=batch_size, shuffle=False),
+                disable=not show_progress,
+            ):
+                batch_tokens = tokenizer(
+                    batch,
+                    return_tensors="pt",
+                    padding=True,
+                    truncation=True,
+                    max_length=MAX_TOKEN_LENGTH,
+                )
+                output = model(**batch_tokens)
+                y_pred.extend(output.logits.argmax(dim=1).tolist())
+
+    if not use_cache:
+        return y_pred
+
+    new_predictions = dict(zip(to_predict, y_pred))
+    cache.put_many(fingerprint, new_predictions)
+    if report:
+        cache.report()
+    predictions.update(new_predictions)
+    return [predictions[x] for x in dataset]
+
+
+def token_budget_batches(lengths: List[int], max_tokens: int) -> List[List[int]]:
+    """Groups texts of similar length into batches that contain at most max_tokens tokens after padding
+
+    :param lengths: tokenized length of each text
+    :param max_tokens: maximum of (number of texts * longest text) per batch, a batch contains at least one text
+    :return: list of batches, each containing the indices of its texts (ordered by length)
+    """
+    batches = []
+    batch = []
+    for i in sorted(range(len(lengths)), key=lambda i: lengths[i]):
+        # texts are sorted by length, so the current text is the longest one of the batch
+        if batch and (len(batch) + 1) * lengths[i] > max_tokens:
+            batches.append(batch)
+            batch = []
+        batch.append(i)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def predict_length_bucketed(
+    model: "transformers.models",
+    tokenizer,
+    dataset: List[str],
+    max_tokens: int,
+    show_progress: bool = True,
+    bucket_width: int = 16,
+    report: bool = True,
+    bucket_stats: Dict[int, List] = None,
+) -> List[int]:
+    """Predicts the labels for the entries in dataset with batches of texts of similar length, so that little padding
+    is needed and short texts are predicted in large batches. The throughput is reported per length bucket.
+
+    :param model: the model to use for prediction
+    :param tokenizer: the tokenizer used for the model
+    :param dataset: the values to predict
+    :param max_tokens: maximum number of (padded) tokens per batch (see token_budget_batches)
+    :param show_progress: show a progress bar for the batches, defaults to True
+    :param bucket_width: width of the length buckets the throughput is reported for, defaults to 16
+    :param report: print the throughput per length bucket, defaults to True
+    :param bucket_stats: maps the bucket (upper bound of the padded length) to the number of texts and the seconds
+    needed for them, the texts and seconds of this call are added to it (e.g. to aggregate them over several calls),
+    defaults to None
+    :return: list of predictions for dataset (in the order of dataset)
+    """
+    if not dataset:
+        return []
+
+    import torch
+    from tqdm import tqdm
+
+    encodings = tokenizer(dataset, truncation=True, max_length=MAX_TOKEN_LENGTH)
+    lengths = [len(input_ids) for input_ids in encodings["input_ids"]]
+
+    y_pred = [None] * len(dataset)
+    # maps the bucket (upper bound of the padded length) to the number of texts and the seconds needed for them
+    call_stats = defaultdict(lambda: [0, 0.0])
 
     with torch.no_grad():
         model.eval()
-        for batch in tqdm(DataLoader(dataset, batch_size=batch_size, shuffle=False)):
-            batch_tokens = tokenizer(
-                batch, return_tensors="pt", padding=True, truncation=True, max_length=64
+        for batch in tqdm(
+            token_budget_batches(lengths, max_tokens), disable=not show_progress
+        ):
+            start_time = perf_counter()
+            batch_tokens = tokenizer.pad(
+                {key: [values[i] for i in batch] for key, values in encodings.items()},
+                return_tensors="pt",
             )
             output = model(**batch_tokens)
-            y_pred.extend(output.logits.argmax(dim=1).tolist())
+            for i, prediction in zip(batch, output.logits.argmax(dim=1).tolist()):
+                y_pred[i] = prediction
+
+            bucket = -(-lengths[batch[-1]] // bucket_width) * bucket_width
+            call_stats[bucket][0] += len(batch)
+            call_stats[bucket][1] += perf_counter() - start_time
 
+    for bucket, (n_texts, seconds) in sorted(call_stats.items()):
+        if bucket_stats is not None:
+            total = bucket_stats.setdefault(bucket, [0, 0.0])
+            total[0] += n_texts
+            total[1] += seconds
+        if report:
+            print(
+                f"Length {bucket - bucket_width + 1}-{bucket} tokens: {n_texts} texts in {seconds:.1f}s "
+                f"({n_texts / seconds if seconds else 0:.1f} texts/s)"
+            )
     return y_pred
 
 
@@ -76,13 +256,22 @@ def evaluate_model(
     labeled_tweets: pd.DataFrame,
     class_list: List[str],
     log_errors: bool = False,
-) -> None:
-    """Prints out a few evaluations for the model"""
+    use_cache: bool = True,
+) -> float:
+    """Prints out a few evaluations for the model
+
+    :param use_cache: if true, cached predictions are reused (see predict_in_batches), defaults to True
+    :return: the macro F-Score of the model
+    """
+    from sklearn.metrics import classification_report, precision_recall_fscore_support
+
     print("Input DataFrame look like this:")
     print(labeled_tweets.head())
 
     y_true = list(labeled_tweets.label)
-    y_pred = predict_in_batches(model, tokenizer, list(labeled_tweets.text))
+    y_pred = predict_in_batches(
+        model, tokenizer, list(labeled_tweets.text), use_cache=use_cache
+    )
 
     if log_errors:
         for i, (prediction, true_label) in enumerate(zip(y_pred, y_true)):
@@ -100,9 +289,14 @@ def evaluate_model(
 
     print(f"True Distribution: {Counter(y_true)}")
     print(f"Predicted Distribution: {Counter(y_pred)}")
+    return f_score_macro
 
 
 def evaluate_modeL_wrapper(train_files: list[str] = None):
+    from sklearn.model_selection import train_test_split
+
+    from src.discourse_style_metrics.offensiveness_training import read_germeval_data
+
     if not train_files:
         train_files = [
             f"{os.getcwd()}/data/offensiveness_training_data/germeval2018.test_.txt",
@@ -129,6 +323,8 @@ def evaluate_modeL_wrapper(train_files: list[str] = None):
 
 
 if __name__ == "__main__":
+    from timebudget import timebudget
+
     evaluate_modeL_wrapper()
 
     model, tokenizer = load_model("/models/german_hatespeech_detection_finetuned")
@@ -1,8 +1,12 @@
+import hashlib
+import json
 import os
+import shutil
 import sys
 from collections import namedtuple
 from typing import List
 
+import numpy as np
 import pandas as pd
 import torch
 
@@ -17,11 +21,18 @@ from transformers import (
     get_linear_schedule_with_warmup,
 )
 
-CLASS_LIST = ["OFFENSE", "OTHER"]
+from src.discourse_style_metrics.classification_pipeline import classify_stream
+from src.discourse_style_metrics.offensiveness_predict import (
+    CLASS_LIST,
+    MAX_TOKEN_LENGTH,
+)
+from src.utils.output_folders import DATA_CACHE_FOLDER
+
+TOKENIZED_CACHE_FOLDER = DATA_CACHE_FOLDER + "tokenized/"
 
 ArgsDesc = namedtuple(
     "ArgsDesc",
-    "dest num_epochs gradient_accumulation_steps batch_size learning_rate adam_epsilon only_prediction",
+    "dest num_epochs gradient_accumulation_steps batch_size learning_rate adam_epsilon only_prediction num_workers",
 )
 ARGS = ArgsDesc(
     dest="../../data/german_hatespeech_detection_finetuned",
@@ -31,6 +42,7 @@ ARGS = ArgsDesc(
     learning_rate=2e-5,
     adam_epsilon=1e-8,
     only_prediction=None,
+    num_workers=4,
 )
 args = ARGS
 
@@ -59,6 +71,117 @@ class SequenceClassificationDataset(Dataset):
         return {"model_inputs": model_inputs, "label": labels}
 
 
+def tokenized_cache_folder(x, y, tokenizer, max_length: int) -> str:
+    """Returns the folder in which the tokenized texts are cached (keyed by the tokenizer, max_length and the data)"""
+    key = hashlib.sha1()
+    key.update(type(tokenizer).__name__.encode())
+    key.update(json.dumps(tokenizer.get_vocab(), sort_keys=True).encode())
+    key.update(str(max_length).encode())
+    key.update(json.dumps([list(x), [int(label) for label in y]]).encode())
+    return f"{TOKENIZED_CACHE_FOLDER}{key.hexdigest()}/"
+
+
+def tokenize_to_cache(
+    x, y, tokenizer, max_length: int = MAX_TOKEN_LENGTH, batch_size: int = 1000
+) -> str:
+    """Tokenizes the texts once and stores the token ids (padded to max_length), the lengths and the labels as numpy
+    files that can be memory-mapped
+
+    :param x: texts
+    :param y: labels (index in CLASS_LIST)
+    :param tokenizer: the (fast) tokenizer used for the model
+    :param max_length: longer texts are truncated, defaults to MAX_TOKEN_LENGTH
+    :param batch_size: number of texts that are tokenized at once, defaults to 1000
+    :return: folder containing the cached arrays
+    """
+    folder = tokenized_cache_folder(x, y, tokenizer, max_length)
+    if os.path.isdir(folder):
+        return folder
+
+    x = list(x)
+    input_ids = np.full((len(x), max_length), tokenizer.pad_token_id, dtype=np.int32)
+    lengths = np.zeros(len(x), dtype=np.int16)
+    for start in tqdm(range(0, len(x), batch_size), desc="Tokenizing"):
+        encodings = tokenizer(
+            x[start : start + batch_size], truncation=True, max_length=max_length
+        )["input_ids"]
+        for i, ids in enumerate(encodings, start):
+            input_ids[i, : len(ids)] = ids
+            lengths[i] = len(ids)
+
+    # the arrays are written to a temporary folder that is renamed when it is complete, so that an interrupted run
+    # never leaves a folder with arrays of different runs behind
+    temporary_folder = f"{folder[:-1]}.{os.getpid()}.tmp/"
+    shutil.rmtree(temporary_folder, ignore_errors=True)
+    os.makedirs(temporary_folder)
+    np.save(temporary_folder + "input_ids.npy", input_ids)
+    np.save(temporary_folder + "lengths.npy", lengths)
+    np.save(temporary_folder + "labels.npy", np.array(y, dtype=np.int64))
+    try:
+        os.replace(temporary_folder, folder)
+    except OSError:
+        if not os.path.isdir(folder):
+            raise
+        # another process cached the same texts in the meantime
+        shutil.rmtree(temporary_folder)
+    print(f"Tokenized {len(x)} texts into {folder}")
+    return folder
+
+
+class TokenizedDataset(Dataset):
+    """Reads the tokenized texts from the cache (see tokenize_to_cache) instead of tokenizing every batch"""
+
+    def __init__(self, x, y, tokenizer, max_length: int = MAX_TOKEN_LENGTH):
+        self.folder = tokenize_to_cache(x, y, tokenizer, max_length)
+        self.pad_token_id = tokenizer.pad_token_id
+        self._arrays = None
+
+    @property
+    def arrays(self):
+        # opened lazily, so that each DataLoader worker maps the files itself instead of receiving a copy
+        if self._arrays is None:
+            self._arrays = {
+                name: np.load(f"{self.folder}{name}.npy", mmap_mode="r")
+                for name in ["input_ids", "lengths", "labels"]
+            }
+        return self._arrays
+
+    def __getstate__(self):
+        return {**self.__dict__, "_arrays": None}
+
+    def __len__(self):
+        return len(self.arrays["labels"])
+
+    def __getitem__(self, idx):
+        return (
+            self.arrays["input_ids"][idx],
+            self.arrays["lengths"][idx],
+            self.arrays["labels"][idx],
+        )
+
+    def collate_fn(self, batch):
+        lengths = np.array([i[1] for i in batch])
+        # the batch is padded to its longest text only
+        input_ids = np.stack([i[0][: lengths.max()] for i in batch])
+        attention_mask = np.arange(lengths.max())[None, :] < lengths[:, None]
+        model_inputs = {
+            "input_ids": torch.from_numpy(input_ids.astype(np.int64)),
+            "attention_mask": torch.from_numpy(attention_mask.astype(np.int64)),
+        }
+        labels = torch.tensor([i[2] for i in batch])
+        return {"model_inputs": model_inputs, "label": labels}
+
+
+def batch_to_device(batch: dict, device: str) -> dict:
+    """Moves a batch of TokenizedDataset to the device (the DataLoader workers only create cpu tensors)"""
+    return {
+        "model_inputs": {
+            key: value.to(device) for key, value in batch["model_inputs"].items()
+        },
+        "label": batch["label"].to(device),
+    }
+
+
 def read_germeval_data(
     file_paths: List[str], class_list: List[str], label_column: str = "task1"
 ) -> pd.DataFrame:
@@ -86,9 +209,12 @@ def read_germeval_data(
     training_df["task1"] = training_df["task1"].str.replace("\r", "")
     training_df["task2"] = training_df["task2"].str.replace("\r", "")
 
-    training_df["label"] = training_df.apply(
-        lambda x: class_list.index(x[label_column]), axis=1
-    )
+    label_indices = {label: i for i, label in enumerate(class_list)}
+    training_df["label"] = training_df[label_column].map(label_indices)
+    if training_df["label"].isna().any():
+        unknown_labels = set(training_df.loc[training_df["label"].isna(), label_column])
+        raise ValueError(f"Labels {unknown_labels} are not in {class_list}")
+    training_df["label"] = training_df["label"].astype(int)
     # tiny bit of preprocessing to adjust to GermEval text structure (if this is no already present in the data)
     training_df.apply(lambda x: x.replace("\n", "|LBR|"))
     training_df = training_df[["text", "label"]]
@@ -96,20 +222,17 @@ def read_germeval_data(
     return training_df
 
 
-def evaluate_epoch(model, dataset):
-    model.eval()
-    targets = []
-    outputs = []
-    with torch.no_grad():
-        for batch in tqdm(
-            DataLoader(
-                dataset, batch_size=args.batch_size, collate_fn=dataset.collate_fn
-            )
-        ):
-            output = model(**batch["model_inputs"])
-            logits = output.logits
-            targets.extend(batch["label"].float().tolist())
-            outputs.extend(logits.argmax(dim=1).tolist())
+def evaluate_epoch(model, dataset, tokenizer_workers: int = 2):
+    # tokenization of the next batches overlaps with the forward pass
+    targets = [float(label) for _, label in dataset.examples]
+    outputs = classify_stream(
+        (text for text, _ in dataset.examples),
+        model,
+        dataset.tokenizer,
+        batch_size=args.batch_size,
+        tokenizer_workers=tokenizer_workers,
+        device=dataset.device,
+    )
 
     # Simple False Positives /false negatives function???
     precision_macro, recall_macro, f1_macro, _ = precision_recall_fscore_support(
@@ -143,7 +266,8 @@ def main(model_name: str, train_files: List[str]):
     model = AutoModelForSequenceClassification.from_pretrained(model_name)
     tokenizer = AutoTokenizer.from_pretrained(model_name)
 
-    trainset = SequenceClassificationDataset(X_train, y_train, tokenizer)
+    # the training texts are tokenized once and read from the cache in every epoch
+    trainset = TokenizedDataset(X_train, y_train, tokenizer)
     devset = SequenceClassificationDataset(X_test, y_test, tokenizer)
 
     warmup_steps = 0
@@ -152,6 +276,9 @@ def main(model_name: str, train_files: List[str]):
         batch_size=args.batch_size,
         shuffle=True,
         collate_fn=trainset.collate_fn,
+        num_workers=args.num_workers,
+        persistent_workers=args.num_workers > 0,
+        pin_memory=device == "cuda",
     )
     t_total = int(
         len(train_dataloader) * args.num_epochs / args.gradient_accumulation_steps
@@ -199,6 +326,7 @@ def main(model_name: str, train_files: List[str]):
         model.train()
         t = tqdm(train_dataloader)
         for i, batch in enumerate(t):
+            batch = batch_to_device(batch, device)
             with torch.cuda.amp.autocast(enabled=use_amp):
                 output = model(**batch["model_inputs"], labels=batch["label"])
                 loss = output.loss / args.gradient_accumulation_steps
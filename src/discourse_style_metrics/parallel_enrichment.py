@@ -0,0 +1,172 @@
+"""
+    Adds attributes to the tweets of many firestorms in parallel: the work is split into partitions (one per firestorm
+    or, for attributes of the tweet scope, ranges of ids within a firestorm) that are processed by a
+    pool of worker processes. Each worker holds its own mongo connection and at most one copy of the model.
+"""
+
+import math
+import multiprocessing
+import os
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from time import perf_counter
+from typing import Dict, List, Tuple, Union
+
+from src.db.connection import connect_to_mongo
+from src.db.queried import QUERIES, query_iterator
+from src.db.schemes import Tweets
+from src.db.tweet_queries import get_tweets_for_firestorm
+from src.discourse_style_metrics.add_attributes_to_entries import (
+    ATTRIBUTE_GRAPH,
+    add_attributes_to_tweets,
+    attribute_plan,
+)
+
+# a partition is described by the firestorm and the range of ids [lower, upper) (None if unbounded)
+Partition = Tuple[str, Union[int, None], Union[int, None]]
+
+
+def firestorm_partitions(
+    firestorm: str, attributes: List[str], partition_size: int = None
+) -> List[Partition]:
+    """Splits a firestorm into ranges of ids that contain (roughly) partition_size tweets
+
+    :param firestorm: name of the firestorm (key in QUERIES)
+    :param attributes: attributes that should be added
+    :param partition_size: number of tweets per partition, the firestorm is not split if None, defaults to None
+    :return: list of partitions
+    """
+    # attributes of the firestorm scope (e.g. user_type) are calculated from all tweets of the firestorm
+    if not partition_size or any(
+        ATTRIBUTE_GRAPH[attribute].scope == "firestorm"
+        for attribute in attribute_plan(attributes)
+    ):
+        return [(firestorm, None, None)]
+
+    tweet_count = get_tweets_for_firestorm(firestorm).count()
+    if tweet_count <= partition_size:
+        return [(firestorm, None, None)]
+
+    buckets = Tweets._get_collection().aggregate(
+        [
+            {"$match": {"firestorm": firestorm}},
+            {
+                "$bucketAuto": {
+                    "groupBy": "$_id",
+                    "buckets": math.ceil(tweet_count / partition_size),
+                }
+            },
+        ]
+    )
+    lower_bounds = [bucket["_id"]["min"] for bucket in buckets]
+    upper_bounds = lower_bounds[1:] + [None]
+    return [
+        (firestorm, lower, upper) for lower, upper in zip(lower_bounds, upper_bounds)
+    ]
+
+
+def _init_worker(torch_threads: int) -> None:
+    # torch is only needed in the workers, the parent process does not pay for importing it
+    import torch
+
+    # connections must not be shared between processes
+    connect_to_mongo()
+    # otherwise each worker uses all cores for inference
+    torch.set_num_threads(torch_threads)
+
+
+def _enrich_partition(
+    partition: Partition,
+    attributes: List[str],
+    overwrite: bool,
+    offensiveness_band: Tuple[float, float] = None,
+) -> Tuple[Dict[str, int], float]:
+    """Adds the attributes to the tweets of a partition (runs in the worker processes)
+
+    :return: Tuple of (1) the number of tweets each attribute was added to and (2) the seconds it took
+    """
+    start_time = perf_counter()
+    firestorm, lower, upper = partition
+    tweets = get_tweets_for_firestorm(firestorm)
+    if lower is not None:
+        tweets = tweets.filter(id__gte=lower)
+    if upper is not None:
+        tweets = tweets.filter(id__lt=upper)
+
+    added = add_attributes_to_tweets(
+        tweets,
+        attributes,
+        overwrite=overwrite,
+        offensiveness_band=offensiveness_band,
+    )
+    return added, perf_counter() - start_time
+
+
+def enrich_firestorms(
+    attributes: List[str],
+    query_dicts: dict = QUERIES,
+    processes: int = None,
+    partition_size: int = None,
+    overwrite: bool = False,
+    offensiveness_band: Tuple[float, float] = None,
+) -> Dict[str, int]:
+    """Adds the attributes to the tweets of all firestorms with a pool of worker processes
+
+    :param attributes: attributes to add (see ATTRIBUTE_GRAPH in add_attributes_to_entries.py)
+    :param query_dicts: firestorms whose tweets should be enriched, defaults to QUERIES
+    :param processes: number of worker processes, defaults to the number of cores
+    :param partition_size: number of tweets per partition if all attributes have the tweet scope (see
+    ATTRIBUTE_GRAPH), firestorms are not split if None, defaults to None
+    :param overwrite: if true, existing values are recalculated, defaults to False
+    :param offensiveness_band: uncertainty band of the cascade for predicting the offensiveness (see
+    add_attributes_to_tweets), defaults to None
+    :return: dict mapping the attributes to the number of tweets for which they were added (see
+    add_attributes_to_tweets)
+    """
+    processes = processes or os.cpu_count()
+    partitions = [
+        partition
+        for key, _ in query_iterator(query_dicts)
+        for partition in firestorm_partitions(key, attributes, partition_size)
+    ]
+    print(
+        f"Adding {attributes} for {len(partitions)} partitions with {processes} processes."
+    )
+
+    start_time = perf_counter()
+    summary = Counter()
+    with ProcessPoolExecutor(
+        max_workers=processes,
+        # fork would copy the mongo client (and a loaded model) of the parent process
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker,
+        initargs=(max(1, os.cpu_count() // processes),),
+    ) as executor:
+        futures = {
+            executor.submit(
+                _enrich_partition,
+                partition,
+                attributes,
+                overwrite,
+                offensiveness_band,
+            ): partition
+            for partition in partitions
+        }
+        for i, future in enumerate(as_completed(futures)):
+            firestorm, lower, upper = futures[future]
+            added, partition_time = future.result()
+            summary.update(added)
+            print(
+                f"[{i + 1}/{len(partitions)}] {firestorm} (ids {lower} to {upper}): {dict(added)} "
+                f"in {partition_time:.1f}s"
+            )
+
+    print(
+        f"Added {dict(summary)} for {len(partitions)} partitions in {perf_counter() - start_time:.1f}s."
+    )
+    return dict(summary)
+
+
+if __name__ == "__main__":
+    connect_to_mongo()
+    enrich_firestorms(["tweet_type", "user_type", "contains_url"])
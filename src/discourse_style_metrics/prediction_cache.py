@@ -0,0 +1,164 @@
+"""
+    A persistent on-disk cache (sqlite) for the predictions of the offensiveness model. Predictions are keyed by a
+    hash of the (normalized) text and a fingerprint of the model weights and the tokenizer, so retrained models never
+    read predictions of older models.
+    A cache can be used by several threads (its connection is guarded by a lock) and several processes (e.g. the worker
+    processes of parallel_enrichment.py) can write to the same file, readers do not block writers in WAL mode.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from typing import Dict, List
+
+from src.utils.output_folders import DATA_CACHE_FOLDER
+
+PREDICTION_CACHE_FILE = DATA_CACHE_FOLDER + "offensiveness_predictions.sqlite"
+# seconds a write waits for the writes of other processes before failing with "database is locked"
+LOCK_TIMEOUT = 300
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+def model_fingerprint(model, tokenizer) -> str:
+    """Returns a fingerprint of the model weights and the tokenizer (calculated once per model object)
+
+    :param model: the model used for prediction
+    :param tokenizer: the tokenizer used for the model
+    :return: hash identifying the model and tokenizer
+    """
+    if not hasattr(model, "_prediction_cache_fingerprint"):
+        fingerprint = hashlib.sha1()
+        for name, tensor in model.state_dict().items():
+            fingerprint.update(name.encode())
+            fingerprint.update(tensor.cpu().numpy().tobytes())
+        fingerprint.update(type(tokenizer).__name__.encode())
+        fingerprint.update(json.dumps(tokenizer.get_vocab(), sort_keys=True).encode())
+        model._prediction_cache_fingerprint = fingerprint.hexdigest()
+    return model._prediction_cache_fingerprint
+
+
+class PredictionCache:
+    """Stores predictions per model fingerprint and text hash and counts the cache hits"""
+
+    def __init__(self, filename: str = PREDICTION_CACHE_FILE):
+        """
+        :param filename: sqlite file the predictions are stored in, defaults to PREDICTION_CACHE_FILE
+        """
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        self._connection = sqlite3.connect(
+            filename, timeout=LOCK_TIMEOUT, check_same_thread=False
+        )
+        self._lock = threading.Lock()
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS predictions ("
+            "model TEXT NOT NULL, text_hash TEXT NOT NULL, prediction INTEGER NOT NULL, "
+            "PRIMARY KEY (model, text_hash))"
+        )
+        self._connection.commit()
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, fingerprint: str, texts: List[str]) -> Dict[str, int]:
+        """Looks up the cached predictions for the texts
+
+        :param fingerprint: fingerprint of the model (see model_fingerprint)
+        :param texts: texts to look up
+        :return: dict mapping the texts that are cached to their prediction
+        """
+        hashes = {text_hash(text): text for text in set(texts)}
+        predictions = {}
+        hash_list = list(hashes)
+        with self._lock:
+            # sqlite limits the number of variables per statement
+            for i in range(0, len(hash_list), 500):
+                chunk = hash_list[i : i + 500]
+                rows = self._connection.execute(
+                    f"SELECT text_hash, prediction FROM predictions WHERE model = ? "
+                    f"AND text_hash IN ({','.join('?' * len(chunk))})",
+                    [fingerprint, *chunk],
+                )
+                for hashed_text, prediction in rows:
+                    predictions[hashes[hashed_text]] = prediction
+
+            cached = sum(1 for text in texts if text in predictions)
+            self.hits += cached
+            self.misses += len(texts) - cached
+        return predictions
+
+    def put_many(self, fingerprint: str, predictions: Dict[str, int]) -> None:
+        """Stores predictions in the cache
+
+        :param fingerprint: fingerprint of the model (see model_fingerprint)
+        :param predictions: dict mapping texts to their prediction
+        """
+        rows = [
+            (fingerprint, text_hash(text), prediction)
+            for text, prediction in predictions.items()
+        ]
+        with self._lock:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO predictions VALUES (?, ?, ?)", rows
+            )
+            self._connection.commit()
+
+    def models(self) -> Dict[str, int]:
+        """Returns the fingerprints of all models with cached predictions and the number of their predictions"""
+        with self._lock:
+            return dict(
+                self._connection.execute(
+                    "SELECT model, COUNT(*) FROM predictions GROUP BY model"
+                )
+            )
+
+    def evict(self, fingerprint: str) -> int:
+        """Deletes all cached predictions of a model
+
+        :param fingerprint: fingerprint of the model (see model_fingerprint)
+        :return: number of deleted predictions
+        """
+        with self._lock:
+            deleted = self._connection.execute(
+                "DELETE FROM predictions WHERE model = ?", [fingerprint]
+            ).rowcount
+            self._connection.commit()
+        return deleted
+
+    def evict_other_models(self, fingerprint: str) -> int:
+        """Deletes the cached predictions of all models except for one (e.g. the current version)
+
+        :param fingerprint: fingerprint of the model whose predictions are kept
+        :return: number of deleted predictions
+        """
+        with self._lock:
+            deleted = self._connection.execute(
+                "DELETE FROM predictions WHERE model != ?", [fingerprint]
+            ).rowcount
+            self._connection.commit()
+        return deleted
+
+    def report(self) -> None:
+        """Prints the hit rate of the cache"""
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups if lookups else 0
+        print(
+            f"Prediction cache: {self.hits} of {lookups} predictions were cached ({hit_rate:.1%} hit rate)."
+        )
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def default_prediction_cache() -> PredictionCache:
+    """Returns the prediction cache that is used by default (opened on first use)"""
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = PredictionCache()
+    return _default_cache
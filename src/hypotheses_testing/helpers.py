@@ -6,7 +6,7 @@ from scipy.stats import chi2_contingency
 from sklearn.preprocessing import LabelEncoder
 from src.utils.datetime_helpers import (
     round_to_hour_slots,
-    unix_ms_to_ger_date,
+    unix_ms_series_to_ger_dates,
 )
 from src.db.queried import QUERIES
 
@@ -16,9 +16,7 @@ def prepare_data(tweets_df: pd.DataFrame) -> pd.DataFrame:
     tweets_df = tweets_df.drop("_id", axis=1)
 
     # calc time of day
-    tweets_df["created_at"] = tweets_df["created_at"].apply(
-        lambda x: unix_ms_to_ger_date(x["$date"])
-    )
+    tweets_df["created_at"] = unix_ms_series_to_ger_dates(tweets_df["created_at"])
 
     tweets_df["six_hour_slot"] = tweets_df["created_at"].apply(
         lambda x: round_to_hour_slots(x, 6)
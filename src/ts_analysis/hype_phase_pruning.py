@@ -88,7 +88,7 @@ def pruning_plot(query_dicts: dict, output_folder: str) -> None:
         query_dicts=query_dicts,
         include_timeseries_disabled=True,  # plotting even those excluded here!
     ):
-        firestorm = Tweets.from_query(query_dict["query"], filters=[de_filter()])
+        firestorm = Tweets.from_firestorm(key, filters=[de_filter()])
 
         layout = go.Layout(
             xaxis={
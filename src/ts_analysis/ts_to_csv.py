@@ -46,8 +46,8 @@ def timeseries_summarized_to_csvs(
     # Writing Data
     for key, query_dict in query_iterator(QUERIES, include_timeseries_disabled=False):
         # Loading the firestorm
-        firestorm = Tweets.from_query(
-            query_dict["query"], filters=default_filters_factory(query_dict)
+        firestorm = Tweets.from_firestorm(
+            key, filters=default_filters_factory(query_dict)
         )
         aggr_writer.writerow([key] + offensiveness_per_hour(firestorm))
         quantity_writer.writerow([key] + tweet_quantity_per_hour(firestorm))
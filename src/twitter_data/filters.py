@@ -5,6 +5,8 @@ def equality_filter_factory(attribute: str, expected_value: any):
     def equality_filter(tweets):
         return tweets[tweets[attribute] == expected_value]
 
+    # description of the filter (e.g. used for identifying cached firestorms)
+    equality_filter.spec = ("equality", attribute, expected_value)
     return equality_filter
 
 
@@ -23,9 +25,34 @@ def between_filter_factory(attribute: str, lower_bound: any, upper_bound: any):
             (tweets[attribute] >= lower_bound) & (tweets[attribute] < upper_bound)
         ]
 
+    between_filter.spec = ("between", attribute, lower_bound, upper_bound)
     return between_filter
 
 
+def filter_to_mongo_match(filter) -> dict:
+    """Translates a filter into the equivalent condition for a mongo query/$match stage
+
+    :param filter: filter created by one of the factories in this file
+    :return: condition that selects the same tweets in the db as the filter does in a DataFrame
+    """
+    if not hasattr(filter, "spec"):
+        raise ValueError(f"The filter {filter} cannot be translated to a mongo query.")
+
+    filter_type, attribute, *values = filter.spec
+    if filter_type == "equality":
+        return {attribute: values[0]}
+    elif filter_type == "between":
+        lower_bound, upper_bound = values
+        if not lower_bound or not upper_bound:
+            print(
+                "Warning: Firestorm had no true_start or end_date. Filter does not match any tweets."
+            )
+            return {"_id": {"$in": []}}
+        return {attribute: {"$gte": lower_bound, "$lt": upper_bound}}
+    else:
+        raise ValueError(f"Unknown filter type {filter_type}")
+
+
 def default_filters_factory(query_dict: dict):
     return [
         between_filter_factory(
@@ -44,7 +44,7 @@ def hourly_quantities_to_csv(
     with open(output_filename, "w") as f:
         writer = csv.writer(f)
         for key, query_dict in query_iterator(queries):
-            firestorm = Tweets.from_query(query_dict["query"], filters=[de_filter()])
+            firestorm = Tweets.from_firestorm(key, filters=[de_filter()])
             writer.writerow([key] + tweet_quantity_per_hour(firestorm))
 
 
@@ -60,17 +60,15 @@ def firestorm_overview_to_csv(
     with open(output_filename, "w") as f:
         writer = csv.writer(f)
         # Write Headers
-        first_query_dict = list(queries.items())[0][1]
-        first_firestorm = Tweets.from_query(
-            first_query_dict["query"], filters=[de_filter()]
-        )
+        first_key, first_query_dict = list(queries.items())[0]
+        first_firestorm = Tweets.from_firestorm(first_key, filters=[de_filter()])
         writer.writerow(
             ["key"]
             + list(get_firestorms_metadata(first_firestorm, first_query_dict).keys())
         )
         # Write Body
         for key, query_dict in query_iterator(queries):
-            firestorm = Tweets.from_query(query_dict["query"], filters=[de_filter()])
+            firestorm = Tweets.from_firestorm(key, filters=[de_filter()])
             firestorm_summary = get_firestorms_metadata(firestorm, query_dict)
             writer.writerow([key] + list(firestorm_summary.values()))
 
@@ -1,26 +1,69 @@
 from typing import Sequence, Tuple
 
 import pandas as pd
+from mongoengine import QuerySet
 
-from src.db.tweet_queries import get_tweets_for_search_query
+from src.db import firestorm_cache
+from src.db.tweet_queries import (
+    counts_per_time_intervall,
+    get_tweets_for_firestorm,
+    get_tweets_for_search_query,
+)
 from src.db.helpers import query_set_to_df
 from src.graphs.line_plots import df_smoothed_line_plots
+from src.twitter_data.filters import filter_to_mongo_match
 from src.utils.datetime_helpers import (
-    round_to_hour,
     round_to_hour_slots,
-    unix_ms_to_ger_date,
+    unix_ms_series_to_ger_dates,
 )
 from src.utils.conversions import float_to_pct
 
 
+DEFAULT_METRICS = [
+    # ==tweet type
+    ("retweet_pct", "tweet_type", "retweet without comment"),
+    ("original_tweet_pct", "tweet_type", "original tweet"),
+    ("reply_pct", "tweet_type", "reply"),
+    ("quoted_pct", "tweet_type", "retweet with comment"),
+    # ==user type
+    ("laggards_pct", "user_type", "laggard"),
+    ("active_pct", "user_type", "active"),
+    ("hyper_active_pct", "user_type", "hyper-active"),
+    # ==lang
+    ("de_pct", "lang", "de"),
+    ("en_pct", "lang", "en"),
+    # ==offensiveness
+    (
+        "offensive_pct",
+        "is_offensive",
+        True,
+    ),  # CAREFUL WITH THE NONE VALUES - i.e. not all value are labeled as offensive/not offensive!
+    (
+        "not_offensive_pct",
+        "is_offensive",
+        False,
+    ),  # FOR TESTING AROUND WITH NONE VALUES
+]
+
+
 class Tweets:
-    def __init__(self, tweets: pd.DataFrame, filters=[]):
-        self._tweets = self._preprocess_inputs(tweets)
+    def __init__(
+        self, tweets: pd.DataFrame, filters=[], metrics_backend: str = "local"
+    ):
+        """
+        :param tweets: tweets as a DataFrame (None if they are loaded lazily, see from_query)
+        :param filters: filters that are applied to the tweets, defaults to []
+        :param metrics_backend: backend used for calculating the metrics per time intervall ('local' or 'mongo',
+        see metrics_per_time_intervall), defaults to "local"
+        """
+        self._filters = filters
+        self._metrics_backend = metrics_backend
+        self._query_set = None
+        self._load_tweets = None
 
-        self._filter_log = [len(self._tweets)]
-        for filter in filters:
-            self._tweets = filter(self._tweets)
-            self._filter_log.append(len(self._tweets))
+        self._tweets, self._filter_log = None, None
+        if tweets is not None:
+            self._tweets, self._filter_log = self._preprocess_and_filter(tweets)
 
     def __len__(self):
         return len(self.tweets)
@@ -31,22 +74,89 @@ class Tweets:
         fetch_query: str,
         filters=[],
         full_match_required: bool = True,
+        use_cache: bool = True,
+        metrics_backend: str = "local",
     ):
-        """Returns all tweets that were fetched by making use of the specified query
+        """Returns all tweets that were fetched by making use of the specified query. The tweets are only loaded
+        from the db once they are accessed (the metrics of the mongo backend do not require loading them).
 
         :param fetch_query: the fetch_query for which tweets should be returned (query originally used for fetching!)
         :param full_match_required: if false, tweets are returned if they were fetched with fetch_query
         if true the fetch_query must be fully equal to the query used for fetching the tweets
+        :param use_cache: if true, the preprocessed and filtered tweets are read from (or written to) the local
+        firestorm cache (see src/db/firestorm_cache.py)
+        :param metrics_backend: backend used for calculating the metrics per time intervall ('local' or 'mongo',
+        see metrics_per_time_intervall), defaults to "local"
         :return: all tweets who were fetched with fetch_query
         """
-        firestorm_tweets_query_set = get_tweets_for_search_query(
-            fetch_query, full_match_required=full_match_required
+        return cls.from_query_set(
+            get_tweets_for_search_query(
+                fetch_query, full_match_required=full_match_required
+            ),
+            filters=filters,
+            use_cache=use_cache,
+            metrics_backend=metrics_backend,
         )
 
-        return cls(query_set_to_df(firestorm_tweets_query_set), filters=filters)
+    @classmethod
+    def from_firestorm(
+        cls,
+        firestorm: str,
+        filters=[],
+        use_cache: bool = True,
+        metrics_backend: str = "local",
+    ):
+        """Returns all tweets that are tagged with the firestorm (see from_query for the remaining parameters)
+
+        :param firestorm: name of the firestorm (key in QUERIES)
+        :return: all tweets of the firestorm
+        """
+        return cls.from_query_set(
+            get_tweets_for_firestorm(firestorm),
+            filters=filters,
+            use_cache=use_cache,
+            metrics_backend=metrics_backend,
+        )
+
+    @classmethod
+    def from_query_set(
+        cls,
+        firestorm_tweets_query_set: QuerySet,
+        filters=[],
+        use_cache: bool = True,
+        metrics_backend: str = "local",
+    ):
+        """Returns the tweets of the query set, which are only loaded from the db once they are accessed (see
+        from_query for the remaining parameters)
+
+        :param firestorm_tweets_query_set: query set selecting the tweets
+        :return: all tweets of the query set
+        """
+
+        def load_firestorm():
+            firestorm = cls(
+                query_set_to_df(firestorm_tweets_query_set), filters=filters
+            )
+            return firestorm.tweets, {"filter_log": firestorm.filter_log}
+
+        def load_tweets():
+            if not use_cache:
+                tweets_df, metadata = load_firestorm()
+            else:
+                tweets_df, metadata = firestorm_cache.cached_frame(
+                    firestorm_tweets_query_set, load_firestorm, filters
+                )
+            return cls(tweets_df).tweets, metadata["filter_log"]
+
+        firestorm = cls(None, filters=filters, metrics_backend=metrics_backend)
+        firestorm._query_set = firestorm_tweets_query_set
+        firestorm._load_tweets = load_tweets
+        return firestorm
 
     @property
     def tweets(self):
+        if self._tweets is None:
+            self._tweets, self._filter_log = self._load_tweets()
         return self._tweets
 
     @property
@@ -65,8 +175,25 @@ class Tweets:
 
     @property
     def filter_log(self):
+        if self._filter_log is None:
+            self._tweets, self._filter_log = self._load_tweets()
         return self._filter_log
 
+    def _preprocess_and_filter(self, tweets: pd.DataFrame) -> Tuple[pd.DataFrame, list]:
+        """Preprocesses the tweets and applies the filters to them
+
+        :param tweets: tweets to preprocess and filter
+        :return: Tuple of (1) the filtered tweets and (2) the number of tweets before and after each filter
+        """
+        tweets = self._preprocess_inputs(tweets)
+
+        filter_log = [len(tweets)]
+        for filter in self._filters:
+            tweets = filter(tweets)
+            filter_log.append(len(tweets))
+
+        return tweets, filter_log
+
     def _preprocess_inputs(self, tweets: pd.DataFrame) -> pd.DataFrame:
         """Parses created_at to datetime, adds hour attributes and casts categorical variables (e.g. tweet type) to
         categorical dytpe
@@ -87,28 +214,31 @@ class Tweets:
             categories=["laggard", "hyper-active", "active"]
         )
 
-        # adding date attributes
-        try:
-            tweets["created_at"] = tweets["created_at"].apply(
-                lambda x: unix_ms_to_ger_date(x["$date"])
+        # adding date attributes (only if the dates were not parsed before, i.e. are still unix timestamps in ms)
+        if "created_at" in tweets.columns and pd.api.types.is_numeric_dtype(
+            tweets["created_at"]
+        ):
+            tweets["created_at"] = unix_ms_series_to_ger_dates(tweets["created_at"])
+            # german utc offsets are full hours, so rounding in utc is the same as rounding in german time
+            tweets["hour"] = (
+                tweets["created_at"]
+                .dt.tz_convert("UTC")
+                .dt.floor("h")
+                .dt.tz_convert("Europe/Berlin")
             )
-            tweets["hour"] = tweets["created_at"].apply(lambda x: round_to_hour(x))
             tweets["six_hour_slot"] = tweets["created_at"].apply(
                 lambda x: round_to_hour_slots(x)
             )
-        except Exception:
-            # dirty solution: the upper code fails if we had already parsed the dates before
-            pass
 
         # casting attributes to categorical
         if (
             "tweet_type" in tweets.columns
-            and str(tweets.dtypes["tweet_type"]) != "category"
+            and tweets.dtypes["tweet_type"] != TWEET_TYPE_LEVELS
         ):
             tweets["tweet_type"] = tweets["tweet_type"].astype(TWEET_TYPE_LEVELS)
         if (
             "user_type" in tweets.columns
-            and str(tweets.dtypes["user_type"]) != "category"
+            and tweets.dtypes["user_type"] != USER_TYPE_LEVELS
         ):
             tweets["user_type"] = tweets["user_type"].astype(USER_TYPE_LEVELS)
         if "lang" in tweets.columns and str(tweets.dtypes["lang"]) != "category":
@@ -120,6 +250,7 @@ class Tweets:
         self,
         grouping_var: str = "hour",
         to_calculate: Sequence[Tuple[str, str, str]] = None,
+        backend: str = None,
     ) -> pd.DataFrame:
         """Groups the tweets per hour and calculates percentages for certain values in categorical variables that
         were specified in to_calculate (e.g. ("retweet_pct", 'tweet_type', 'retweet without comment') will include the
@@ -130,53 +261,26 @@ class Tweets:
         1. colname: name that the output column should have (e.g. 'retweet_pct')
         2. variable_name: name of variable in input column (e.g. 'tweet_type')
         3. value: value for which the rate should be calculated (e.g. 'retweet without comment')
+        :param backend: 'local' calculates the metrics on the loaded tweets, 'mongo' sends a single aggregation to
+        the db and only loads the counts per time intervall (only for tweets created with from_query),
+        defaults to the metrics_backend of the tweets
         :return: data frame with metrics(rates) for each hour for some variables
         """
 
         if not to_calculate:
-            to_calculate = [
-                # ==tweet type
-                ("retweet_pct", "tweet_type", "retweet without comment"),
-                ("original_tweet_pct", "tweet_type", "original tweet"),
-                ("reply_pct", "tweet_type", "reply"),
-                ("quoted_pct", "tweet_type", "retweet with comment"),
-                # ==user type
-                ("laggards_pct", "user_type", "laggard"),
-                ("active_pct", "user_type", "active"),
-                ("hyper_active_pct", "user_type", "hyper-active"),
-                # ==lang
-                ("de_pct", "lang", "de"),
-                ("en_pct", "lang", "en"),
-                # ==offensiveness
-                (
-                    "offensive_pct",
-                    "is_offensive",
-                    True,
-                ),  # CAREFUL WITH THE NONE VALUES - i.e. not all value are labeled as offensive/not offensive!
-                (
-                    "not_offensive_pct",
-                    "is_offensive",
-                    False,
-                ),  # FOR TESTING AROUND WITH NONE VALUES
-            ]
-
-        # setting up the output_df
-        # index should contain hour (not just hours were tweets occured)
-        first_timestamp = self.tweets[grouping_var].min()
-        last_timestamp = self.tweets[grouping_var].max()
-        hourly_timestamps = pd.date_range(first_timestamp, last_timestamp, freq="h")
-
-        cols = [x[0] for x in to_calculate]
-        cols.extend(["total_tweets", "total_tweets_pct"])
-        output_df = pd.DataFrame(columns=cols, index=hourly_timestamps)
-        output_df[
-            "hour"
-        ] = output_df.index  # also have index as column (often useful for plotting)
-
-        # intialize empty df with 0s
-        output_df = output_df.fillna(
-            0.0
-        )  # we need 0.0 so the col.dtype is float instead of int
+            to_calculate = DEFAULT_METRICS
+
+        backend = backend or self._metrics_backend
+        if backend == "mongo":
+            return self._metrics_per_time_intervall_mongo(grouping_var, to_calculate)
+        elif backend != "local":
+            raise ValueError(f"Unknown backend {backend} for calculating metrics.")
+
+        output_df = self._empty_metrics_df(
+            self.tweets[grouping_var].min(),
+            self.tweets[grouping_var].max(),
+            to_calculate,
+        )
 
         # group all tweets that appeared in the same hour and calculate stats for them
         tweets_by_hour = self.tweets.groupby(grouping_var)
@@ -192,6 +296,64 @@ class Tweets:
                 except KeyError:  # sometimes value does not exist in value_counts (0 entries)
                     output_df.at[name, col] = 0
 
+        return self._normalized_metrics_df(output_df)
+
+    def _metrics_per_time_intervall_mongo(
+        self, grouping_var: str, to_calculate: Sequence[Tuple[str, str, str]]
+    ) -> pd.DataFrame:
+        """Same as metrics_per_time_intervall but the tweets are counted with an aggregation in the db"""
+        if self._query_set is None:
+            raise ValueError(
+                "The mongo backend is only available for tweets that were created with from_query."
+            )
+
+        intervall_counts = counts_per_time_intervall(
+            self._query_set,
+            grouping_var,
+            to_calculate,
+            match=[filter_to_mongo_match(filter) for filter in self._filters],
+        )
+        intervall_starts = pd.to_datetime(
+            [counts["_id"] for counts in intervall_counts], utc=True
+        ).tz_convert("Europe/Berlin")
+
+        output_df = self._empty_metrics_df(
+            intervall_starts.min(), intervall_starts.max(), to_calculate
+        )
+        for name, counts in zip(intervall_starts, intervall_counts):
+            total_length = counts["total_tweets"]
+            output_df.at[name, "total_tweets"] = total_length
+            for col, _, _ in to_calculate:
+                output_df.at[name, col] = counts[col] / total_length
+
+        return self._normalized_metrics_df(output_df)
+
+    @staticmethod
+    def _empty_metrics_df(
+        first_timestamp, last_timestamp, to_calculate: Sequence[Tuple[str, str, str]]
+    ) -> pd.DataFrame:
+        """Sets up the output_df for metrics_per_time_intervall (all metrics are 0 for every hour, empty if the
+        timestamps are NaT)"""
+        if pd.isna(first_timestamp):  # no tweets (e.g. all were filtered out)
+            hourly_timestamps = pd.DatetimeIndex([], tz="Europe/Berlin")
+        else:
+            # index should contain hour (not just hours were tweets occured)
+            hourly_timestamps = pd.date_range(first_timestamp, last_timestamp, freq="h")
+
+        cols = [x[0] for x in to_calculate]
+        cols.extend(["total_tweets", "total_tweets_pct"])
+        output_df = pd.DataFrame(columns=cols, index=hourly_timestamps)
+        output_df[
+            "hour"
+        ] = output_df.index  # also have index as column (often useful for plotting)
+
+        # intialize empty df with 0s
+        return output_df.fillna(
+            0.0
+        )  # we need 0.0 so the col.dtype is float instead of int
+
+    @staticmethod
+    def _normalized_metrics_df(output_df: pd.DataFrame) -> pd.DataFrame:
         # Normalizing total length (only works since data has only positive values)
         output_df["total_tweets_pct"] = (
             output_df["total_tweets"] / output_df["total_tweets"].max()
@@ -232,8 +394,8 @@ if __name__ == "__main__":
 
     connect_to_mongo()
     query_dict = QUERIES["pinkygloves"]
-    firestorm = Tweets.from_query(
-        query_dict["query"],
+    firestorm = Tweets.from_firestorm(
+        "pinkygloves",
         filters=default_filters_factory(query_dict),
     )
 
@@ -4,6 +4,7 @@ from json import dumps
 from typing import Dict, List, Sequence, Union
 
 import src.db.schemes as mongo_db
+from src.db.queried import firestorm_for_query
 
 
 class TwitterSearchResponse:
@@ -68,6 +69,7 @@ class TwitterSearchResponse:
     def write_to_db(self) -> None:
         for entry in self.attach_media_to_tweets():
             entry["search_params"] = self.search_params
+            entry["firestorm"] = firestorm_for_query(self.search_params.get("query"))
             mongo_db.Tweets.from_json(dumps(entry), True).save()
 
         for user in self.users:
@@ -1,5 +1,6 @@
 from datetime import datetime, timedelta, time, timezone
 from typing import Tuple
+import pandas as pd
 import pytz
 
 
@@ -10,6 +11,11 @@ def unix_ms_to_ger_date(unix_ms: int) -> datetime:
     return ger_timestamp
 
 
+def unix_ms_series_to_ger_dates(unix_ms: pd.Series) -> pd.Series:
+    """Vectorized version of unix_ms_to_ger_date for a whole series of unix timestamps (in ms)"""
+    return pd.to_datetime(unix_ms, unit="ms", utc=True).dt.tz_convert("Europe/Berlin")
+
+
 def round_to_hour(t: datetime) -> datetime:
     """Returns the datetime rounded down to the hour"""
     return t.replace(second=0, microsecond=0, minute=0, hour=t.hour)
@@ -6,6 +6,7 @@ WORKING_DIRECTORY = "/home/david/Desktop/Masterarbeit/twit_scrape"
 DATA_BASE_FOLDER = WORKING_DIRECTORY + "/data/"
 DATA_TIME_SERIES_FOLDER = DATA_BASE_FOLDER + "hourly_timeseries/"
 DATA_HYPE_PHASE_TS_FOLDER = DATA_BASE_FOLDER + "hourly_timeseries/hype_phase/"
+DATA_CACHE_FOLDER = DATA_BASE_FOLDER + "cache/"
 
 # Plot Folders
 PLOT_BASE_FOLDER = WORKING_DIRECTORY + "/plots/"
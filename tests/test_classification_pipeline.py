@@ -0,0 +1,73 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from src.discourse_style_metrics.classification_pipeline import classify_stream
+
+
+def length_tokenizer(texts, **kwargs):
+    if any(text is None for text in texts):
+        raise TypeError("texts must be strings")
+    return {"lengths": torch.tensor([[len(text)] for text in texts])}
+
+
+class ParityModel:
+    """Predicts 0 for texts of odd length and 1 for texts of even length"""
+
+    def eval(self):
+        return self
+
+    def __call__(self, lengths):
+        return SimpleNamespace(logits=torch.cat([1 - lengths % 2, lengths % 2], dim=1))
+
+
+def test_classify_stream_keeps_order():
+    texts = ["a" * i for i in range(1, 500)]
+    predictions = classify_stream(
+        texts, ParityModel(), length_tokenizer, batch_size=7, tokenizer_workers=3
+    )
+    assert predictions == [len(text) % 2 for text in texts]
+
+
+@pytest.mark.parametrize("tokenizer_workers", [1, 3])
+def test_classify_stream_raises_tokenizer_errors(tokenizer_workers):
+    texts = [None] + ["a" * i for i in range(1, 1000)]
+    with pytest.raises(TypeError):
+        classify_stream(
+            texts,
+            ParityModel(),
+            length_tokenizer,
+            tokenizer_workers=tokenizer_workers,
+            text_queue_depth=1,
+        )
+
+
+class ExclusiveTokenizer:
+    """Fails like a fast tokenizer that is called by two threads at the same time"""
+
+    def __init__(self):
+        self._in_use = threading.Lock()
+
+    def __deepcopy__(self, memo):
+        return ExclusiveTokenizer()
+
+    def __call__(self, texts, **kwargs):
+        if not self._in_use.acquire(blocking=False):
+            raise RuntimeError("Already borrowed")
+        try:
+            time.sleep(0.001)
+            return length_tokenizer(texts)
+        finally:
+            self._in_use.release()
+
+
+def test_classify_stream_copies_the_tokenizer_per_thread():
+    texts = ["a" * i for i in range(1, 500)]
+    predictions = classify_stream(
+        texts, ParityModel(), ExclusiveTokenizer(), batch_size=7, tokenizer_workers=3
+    )
+    assert predictions == [len(text) % 2 for text in texts]
@@ -0,0 +1,55 @@
+import pytest
+
+from src.discourse_style_metrics import offensiveness_predict
+from src.discourse_style_metrics.offensiveness_predict import (
+    predict_in_batches,
+    predict_length_bucketed,
+)
+from src.discourse_style_metrics.prediction_cache import PredictionCache
+
+
+class UnusedModel:
+    """Fails if it is run, the predictions must come from the cache"""
+
+    _prediction_cache_fingerprint = "test-model"
+
+    def __call__(self, **tokens):
+        raise AssertionError("the model should not be run")
+
+
+def unused_tokenizer(*args, **kwargs):
+    raise AssertionError("the tokenizer should not be run")
+
+
+@pytest.fixture
+def prediction_cache(tmp_path, monkeypatch):
+    cache = PredictionCache(str(tmp_path / "predictions.sqlite"))
+    monkeypatch.setattr(
+        offensiveness_predict, "default_prediction_cache", lambda: cache
+    )
+    return cache
+
+
+def test_predict_length_bucketed_empty():
+    assert predict_length_bucketed(UnusedModel(), unused_tokenizer, [], 256) == []
+
+
+@pytest.mark.parametrize("max_tokens", [None, 256])
+def test_predict_in_batches_empty(prediction_cache, max_tokens):
+    assert (
+        predict_in_batches(UnusedModel(), unused_tokenizer, [], max_tokens=max_tokens)
+        == []
+    )
+
+
+@pytest.mark.parametrize("max_tokens", [None, 256])
+def test_predict_in_batches_fully_cached(prediction_cache, max_tokens):
+    prediction_cache.put_many("test-model", {"du idiot": 0, "hallo": 1})
+
+    predictions = predict_in_batches(
+        UnusedModel(),
+        unused_tokenizer,
+        ["hallo", "du idiot", "hallo"],
+        max_tokens=max_tokens,
+    )
+    assert predictions == [1, 0, 1]
@@ -0,0 +1,34 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from src.discourse_style_metrics.prediction_cache import PredictionCache
+
+
+def test_cache_can_be_used_by_other_threads(tmp_path):
+    cache = PredictionCache(str(tmp_path / "predictions.sqlite"))
+    cache.put_many("test-model", {"a": 0})
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        list(
+            executor.map(
+                lambda i: cache.put_many("test-model", {f"text {i}": i % 2}), range(100)
+            )
+        )
+        cached = executor.submit(cache.get_many, "test-model", ["a", "text 1"]).result()
+
+    assert cached == {"a": 0, "text 1": 1}
+    assert cache.models() == {"test-model": 101}
+
+
+def test_caches_of_several_processes_write_to_the_same_file(tmp_path):
+    filename = str(tmp_path / "predictions.sqlite")
+
+    def write(worker: int) -> None:
+        # each worker process opens its own connection
+        cache = PredictionCache(filename)
+        for i in range(50):
+            cache.put_many("test-model", {f"text {worker} {i}": i % 2})
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        list(executor.map(write, range(4)))
+
+    assert PredictionCache(filename).models() == {"test-model": 200}